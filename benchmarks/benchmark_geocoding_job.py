@@ -0,0 +1,149 @@
+"""
+An end-to-end throughput benchmark of GeocodingJob against a LocalDataflowServer.
+
+Every input size is run in a process of its own so that the peak RSS reported for it is not inflated by the
+earlier runs. The stand-in server runs in yet another process. Example:
+
+    python -m benchmarks.benchmark_geocoding_job --sizes 1000 100000 1000000 --min-rows-per-second 5000
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import numpy
+import pandas
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.polling_policy import PollingPolicy
+from geocoding_job.instrumentation import MetricsCollector
+from benchmarks.local_dataflow_server import LocalDataflowServer
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+PHASES = ["build", "upload", "wait", "collect"]
+
+
+def generate_input(row_count, seed=0):
+    """
+    :param row_count: The number of rows to generate
+    :param seed: The random seed
+    :return: A dataframe of synthetic addresses in the input format of GeocodingJob
+    """
+    random = numpy.random.RandomState(seed)
+    streets = pandas.Series(["Mannerheimintie", "Hameenkatu", "Aleksanterinkatu", "Kauppakatu", "Rantatie"])
+    municipalities = pandas.Series(["Helsinki", "Tampere", "Turku", "Oulu", "Vantaa", numpy.nan])
+    return pandas.DataFrame({
+        'id': numpy.arange(row_count),
+        'streetAddress': streets[random.randint(0, len(streets), row_count)].values + " " +
+                         pandas.Series(random.randint(1, 200, row_count)).astype(str).values,
+        'postcode': random.randint(100, 99999, row_count),
+        'municipality': municipalities[random.randint(0, len(municipalities), row_count)].values})
+
+
+def run_benchmark(row_count, dataflow_url):
+    """
+    Geocodes row_count synthetic rows against the server, in as many jobs as the Bing entity limit requires.
+
+    :param row_count: The number of rows to geocode
+    :param dataflow_url: The dataflow url of a running LocalDataflowServer
+    :return: A dict of the measurements
+    """
+    data = generate_input(row_count)
+    timings = dict.fromkeys(PHASES, 0.0)
+    collector = MetricsCollector()
+    started = time.time()
+
+    phase_started = time.time()
+    jobs = [GeocodingJob(data.iloc[start:start + GeocodingJob.MAX_ENTITIES_PER_JOB], bing_key="benchmark",
+                         dataflow_url=dataflow_url, polling_policy=PollingPolicy(initial_interval_seconds=0.1),
+                         instrumentation=collector)
+            for start in range(0, row_count, GeocodingJob.MAX_ENTITIES_PER_JOB)]
+    del data
+    timings["build"] = time.time() - phase_started
+
+    phase_started = time.time()
+    for job in jobs:
+        job.submit()
+    timings["upload"] = time.time() - phase_started
+
+    phase_started = time.time()
+    pending = list(jobs)
+    while pending:
+        pending = [job for job in pending if not job.poll()]
+        if pending:
+            time.sleep(min(job.next_poll_interval() for job in pending))
+    timings["wait"] = time.time() - phase_started
+
+    phase_started = time.time()
+    result_rows = 0
+    for job in jobs:
+        result_rows += len(job.collect())
+        # The rows failed by transient faults are resubmitted in follow-up jobs, which are waited for here.
+        if job.retry_job is not None:
+            result_rows += len(job.retry_job.fetch_results())
+    timings["collect"] = time.time() - phase_started
+    total_seconds = time.time() - started
+
+    return {'rows': row_count, 'result_rows': result_rows, 'seconds': total_seconds,
+            'rows_per_second': row_count / total_seconds,
+            # ru_maxrss is in kilobytes on Linux.
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'phase_seconds': timings,
+            # The finer grained breakdown reported by the jobs themselves, e.g. download and parse separately.
+            'job_phase_seconds': collector.phase_seconds, 'job_phase_bytes': collector.phase_bytes}
+
+
+def _run_in_child(row_count, dataflow_url, queue):
+    try:
+        queue.put(run_benchmark(row_count, dataflow_url))
+    except Exception as e:
+        queue.put({'rows': row_count, 'error': repr(e)})
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark GeocodingJob against a local stand-in Dataflow server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Input sizes in rows")
+    parser.add_argument("--processing-seconds", type=float, default=0.5, help="Simulated queue time per job")
+    parser.add_argument("--seconds-per-entity", type=float, default=0.0, help="Simulated processing per row")
+    parser.add_argument("--min-rows-per-second", type=float, default=None,
+                        help="Exit with an error if any size is slower than this")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON lines")
+    args = parser.parse_args(argv)
+
+    server = LocalDataflowServer(processing_seconds=args.processing_seconds,
+                                 seconds_per_entity=args.seconds_per_entity, seed=0)
+    server_process = multiprocessing.Process(target=server.serve_forever)
+    server_process.daemon = True
+    server_process.start()
+
+    results = []
+    try:
+        for row_count in args.sizes:
+            queue = multiprocessing.Queue()
+            benchmark_process = multiprocessing.Process(target=_run_in_child,
+                                                        args=(row_count, server.dataflow_url, queue))
+            benchmark_process.start()
+            results.append(queue.get())
+            benchmark_process.join()
+    finally:
+        server_process.terminate()
+
+    for result in results:
+        if 'error' in result:
+            print("{rows:>9} rows failed: {error}".format(**result))
+        elif args.json:
+            print(json.dumps(result))
+        else:
+            print("{rows:>9} rows {seconds:8.2f} s {rows_per_second:10.0f} rows/s {peak_rss_mb:8.1f} MB peak RSS | "
+                  .format(**result) +
+                  " ".join("{} {:.2f} s".format(phase, result['phase_seconds'][phase]) for phase in PHASES))
+
+    if args.min_rows_per_second is not None and \
+            any(result['rows_per_second'] < args.min_rows_per_second for result in results if 'error' not in result):
+        return 1
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+import json
+import threading
+import time
+import uuid
+import zlib
+import numpy
+import pandas
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from urlparse import urlparse
+
+
+class LocalDataflowServer:
+    """
+    A local HTTP stand-in for the create, status and output endpoints of the Bing Geocode Dataflow API, for
+    offline testing and benchmarking of GeocodingJob. Jobs stay pending for a configurable processing time, after
+    which the output echoes the request rows with generated coordinates. Failures can be simulated with configurable
+    rates.
+
+    Usage: start the server, then pass server.dataflow_url as the dataflow_url of the jobs.
+    """
+
+    DATAFLOW_PATH = "/REST/v1/Dataflows/Geocode"
+
+    def __init__(self, processing_seconds=0.0, seconds_per_entity=0.0, row_failure_rate=0.0, job_failure_rate=0.0,
+                 http_error_rate=0.0, output_padding_bytes=0, port=0, seed=None):
+        """
+        :param processing_seconds: How long every job stays pending.
+        :param seconds_per_entity: Additional pending time per submitted entity.
+        :param row_failure_rate: The share of rows put in the 'failed' output with a transient ServerError.
+        :param job_failure_rate: The share of jobs that end up 'Aborted'.
+        :param http_error_rate: The share of status and output requests answered with a 503.
+        :param output_padding_bytes: Extra bytes added to the TraceId of each output row, to simulate larger outputs.
+        :param port: The port to listen on. A free port is picked if 0.
+        :param seed: Seed of the random failures and coordinates.
+        """
+        self.processing_seconds = processing_seconds
+        self.seconds_per_entity = seconds_per_entity
+        self.row_failure_rate = row_failure_rate
+        self.job_failure_rate = job_failure_rate
+        self.http_error_rate = http_error_rate
+        self.output_padding_bytes = output_padding_bytes
+        self.jobs = {}
+        self._random = numpy.random.RandomState(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._httpd = _ThreadingHTTPServer(("127.0.0.1", port), _DataflowRequestHandler)
+        self._httpd.dataflow = self
+
+    # Public interface
+    @property
+    def dataflow_url(self):
+        return "http://127.0.0.1:{}{}".format(self._httpd.server_address[1], self.DATAFLOW_PATH)
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+
+        :return: The server itself
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Serves in the calling thread, e.g. in a separate process, until the process is terminated.
+        """
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Private methods
+    def _create_job(self, body, compressed=False):
+        """
+        :param body: The request CSV
+        :param compressed: Whether the request was uploaded gzipped
+        :return: The resource JSON of the created job
+        """
+        payload = pandas.read_csv(StringIO(body), header=1, dtype=str, keep_default_na=False)
+        with self._lock:
+            failed = self._random.random_sample(len(payload)) < self.row_failure_rate
+            aborted = self._random.random_sample() < self.job_failure_rate
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {'id': job_id, 'created': time.time(), 'total': len(payload), 'aborted': aborted,
+                                 'processing_seconds': self.processing_seconds +
+                                 self.seconds_per_entity * len(payload),
+                                 'succeeded': self._render_output(payload[~failed], failed=False),
+                                 'failed': self._render_output(payload[failed], failed=True) if failed.any() else None,
+                                 'failed_count': int(failed.sum()), 'compressed_upload': compressed}
+        return self._resource(job_id)
+
+    def _resource(self, job_id):
+        """
+        :param job_id: The id of a job created by _create_job
+        :return: The resource JSON of the job in its current state
+        """
+        job = self.jobs[job_id]
+        status_url = "{}/{}".format(self.dataflow_url, job_id)
+        progress = min(1.0, (time.time() - job['created']) / job['processing_seconds']) \
+            if job['processing_seconds'] > 0 else 1.0
+        resource = {'id': job_id, 'links': [{'role': 'self', 'url': status_url}],
+                    'totalEntityCount': job['total'], 'processedEntityCount': int(job['total'] * progress)}
+        if progress < 1.0:
+            resource['status'] = 'Pending'
+        elif job['aborted']:
+            resource['status'] = 'Aborted'
+        else:
+            resource['status'] = 'Completed'
+            resource['failedEntityCount'] = job['failed_count']
+            resource['links'].append({'role': 'output', 'name': 'succeeded',
+                                      'url': "{}/output/succeeded".format(status_url)})
+            if job['failed'] is not None:
+                resource['links'].append({'role': 'output', 'name': 'failed',
+                                          'url': "{}/output/failed".format(status_url)})
+        return {'resourceSets': [{'estimatedTotal': 1, 'resources': [resource]}], 'statusCode': 200}
+
+    def _render_output(self, payload, failed):
+        """
+        Generates the output CSV of a job. Like Bing, only the columns of the request header are included.
+
+        :param payload: The request rows as a dataframe of strings
+        :param failed: Whether to render the rows as failed or successfully geocoded ones
+        :return: The output CSV
+        """
+        output = payload.copy()
+        if failed:
+            self._set_columns(output, {"StatusCode": "ServerError", "FaultReason": "Simulated transient fault"})
+        else:
+            latitudes = self._random.uniform(59.8, 70.0, len(output)).round(6)
+            longitudes = self._random.uniform(20.5, 31.5, len(output)).round(6)
+            formatted = (output["GeocodeRequest/Address/AddressLine"] + ", " +
+                         output["GeocodeRequest/Address/PostalCode"] + " " +
+                         output["GeocodeRequest/Address/Locality"])
+            self._set_columns(output, {
+                "GeocodeResponse/Address/AddressLine": output["GeocodeRequest/Address/AddressLine"],
+                "GeocodeResponse/Address/CountryRegion": output["GeocodeRequest/Address/CountryRegion"],
+                "GeocodeResponse/Address/Locality": output["GeocodeRequest/Address/Locality"],
+                "GeocodeResponse/Address/PostalCode": output["GeocodeRequest/Address/PostalCode"],
+                "GeocodeResponse/Address/FormattedAddress": formatted,
+                "GeocodeResponse/Name": formatted,
+                "GeocodeResponse/Confidence": "High",
+                "GeocodeResponse/EntityType": "Address",
+                "GeocodeResponse/MatchCodes": "Good",
+                "GeocodeResponse/Point/Latitude": latitudes,
+                "GeocodeResponse/Point/Longitude": longitudes,
+                "GeocodeResponse/BoundingBox/NorthLatitude": latitudes + 0.001,
+                "GeocodeResponse/BoundingBox/SouthLatitude": latitudes - 0.001,
+                "GeocodeResponse/BoundingBox/EastLongitude": longitudes + 0.002,
+                "GeocodeResponse/BoundingBox/WestLongitude": longitudes - 0.002,
+                "StatusCode": "Success",
+                "TraceId": "local-dataflow-server" + "x" * self.output_padding_bytes})
+        return "Bing Spatial Data Services, 2.0\n" + output.to_csv(index=False)
+
+    @staticmethod
+    def _set_columns(output, values):
+        """
+        Sets the values of those columns that were included in the request header.
+        """
+        for column, value in values.items():
+            if column in output.columns:
+                output[column] = value
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _DataflowRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes the requests of GeocodingJob to the LocalDataflowServer in self.server.dataflow.
+    """
+
+    # HTTP/1.1 keeps the connections alive, like the real service.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if urlparse(self.path).path != LocalDataflowServer.DATAFLOW_PATH:
+            return self._respond(404, "Not found")
+        body = self._read_body()
+        compressed = self.headers.get('Content-Encoding', '').lower() == 'gzip'
+        if compressed:
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self._respond(201, json.dumps(self.server.dataflow._create_job(body, compressed)),
+                      content_type="application/json")
+
+    def do_GET(self):
+        dataflow = self.server.dataflow
+        parts = urlparse(self.path).path[len(LocalDataflowServer.DATAFLOW_PATH) + 1:].split("/")
+        if parts[0] not in dataflow.jobs:
+            return self._respond(404, "Not found")
+        with dataflow._lock:
+            http_error = dataflow._random.random_sample() < dataflow.http_error_rate
+        if http_error:
+            return self._respond(503, "Simulated service unavailability")
+        if len(parts) == 1:
+            return self._respond(200, json.dumps(dataflow._resource(parts[0])), content_type="application/json")
+        output = dataflow.jobs[parts[0]].get(parts[-1]) if parts[1:-1] == ["output"] else None
+        if output is None:
+            return self._respond(404, "Not found")
+        self._respond(200, output, compress='gzip' in self.headers.get('Accept-Encoding', ''))
+
+    def log_message(self, format, *args):
+        # Keep the benchmark and test output clean.
+        pass
+
+    def _read_body(self):
+        """
+        :return: The request body, read by its Content-Length or decoded from the chunked transfer encoding
+        """
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip().split(";")[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return "".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _respond(self, status, body, content_type="text/plain", compress=False):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,254 @@
+"""
+A command-line batch geocoder for input files of any size. Example:
+
+    python -m geocoding_job addresses.csv geocoded.parquet --chunk-size 100000 --max-concurrent-jobs 4
+
+The input is read in chunks and every chunk is geocoded as a GeocodingJob of its own, so that at most
+max_concurrent_jobs chunks and their results are held in memory at any time, regardless of the input size.
+"""
+import argparse
+import functools
+import os
+import sys
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import pandas
+from .geocoding_job import GeocodingJob
+from .http_session import create_session
+from .key_scheduler import KeyScheduler
+from .multi_geocoding_job import fetch_chunk_results, validate_chunking
+from .polling_policy import PollingPolicy
+from .result_cache import ResultCache
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ["csv", "parquet"]
+RESULT_SCHEMAS = {'compact': GeocodingJob.COMPACT_RESULT_SCHEMA, 'full': None}
+
+
+def read_input_chunks(path, chunk_size, input_format=None, delimiter=","):
+    """
+    Reads an input file in chunks.
+
+    :param path: The path of a CSV or Parquet file with the columns 'id', 'streetAddress', 'postcode' and
+           'municipality'
+    :param chunk_size: The maximum number of rows in a chunk
+    :param input_format: 'csv' or 'parquet'. Guessed from the file extension if omitted.
+    :param delimiter: The field delimiter of a CSV file
+    :return: A generator of dataframes of at most chunk_size rows
+    """
+    input_format = input_format or _guess_format(path)
+    if input_format == "csv":
+        for chunk in pandas.read_csv(path, sep=delimiter, chunksize=chunk_size, dtype={'postcode': str}):
+            yield chunk
+    else:
+        parquet_file = pyarrow.parquet.ParquetFile(_require_pyarrow(path))
+        # A row group is the smallest unit a Parquet file can be read in, so only one is held in memory at a time.
+        for row_group in range(parquet_file.num_row_groups):
+            df = parquet_file.read_row_group(row_group, columns=GeocodingJob.INPUT_COLUMNS).to_pandas()
+            for start in range(0, len(df), chunk_size):
+                yield df.iloc[start:start + chunk_size]
+
+
+def geocode_file(input_path, output_path, bing_key=None, chunk_size=GeocodingJob.MAX_ENTITIES_PER_JOB,
+                 max_concurrent_jobs=4, input_format=None, output_format=None, delimiter=",", result_schema=None,
+                 job_factory=GeocodingJob, key_scheduler=None, key_wait_timeout_seconds=None, **job_kwargs):
+    """
+    Geocodes an input file chunk by chunk and streams the results to an output file.
+
+    The chunks are geocoded side by side by max_concurrent_jobs worker threads, and the results of every chunk are
+    written as soon as it and the chunks before it have finished. Reading the input is paused while all the workers
+    are busy, so the memory used stays proportional to chunk_size * max_concurrent_jobs.
+
+    :param input_path: The path of the input file, see read_input_chunks
+    :param output_path: The path of the CSV or Parquet file the results are written to
+    :param bing_key: A valid Bing spatial data API key. Can be omitted in which case an environment variable named
+           BING_API_KEY is required, unless a key_scheduler is given.
+    :param chunk_size: The number of rows geocoded in one job. Cannot exceed GeocodingJob.MAX_ENTITIES_PER_JOB.
+    :param max_concurrent_jobs: The maximum number of Bing jobs in flight at the same time
+    :param input_format: 'csv' or 'parquet'. Guessed from the file extension if omitted.
+    :param output_format: 'csv' or 'parquet'. Guessed from the file extension if omitted.
+    :param delimiter: The field delimiter of a CSV input file
+    :param result_schema: An optional dict of column name to dtype, see GeocodingJob.fetch_results
+    :param job_factory: The class of the jobs, GeocodingJob or a compatible one
+    :param key_scheduler: An optional key_scheduler.KeyScheduler the key of every job is leased from
+    :param key_wait_timeout_seconds: The longest time a chunk waits for a key of the key_scheduler, or None to wait
+           for as long as it takes
+    :param job_kwargs: Other parameters of the jobs, e.g. cache or deduplicate
+    :return: The number of result rows written
+    """
+    validate_chunking(chunk_size, max_concurrent_jobs)
+    bing_key = bing_key if bing_key is not None or key_scheduler is not None else os.environ["BING_API_KEY"]
+    job_kwargs.setdefault('session', create_session(pool_size=max_concurrent_jobs))
+    writer = _create_writer(output_path, output_format or _guess_format(output_path))
+    pool = ThreadPool(max_concurrent_jobs)
+    in_flight = deque()
+    row_count = 0
+    try:
+        for chunk in read_input_chunks(input_path, chunk_size, input_format, delimiter):
+            if len(in_flight) >= max_concurrent_jobs:
+                row_count += writer.write(in_flight.popleft().get())
+            in_flight.append(pool.apply_async(_geocode_chunk, (job_factory, chunk, bing_key, key_scheduler,
+                                                               key_wait_timeout_seconds, result_schema, job_kwargs)))
+        while in_flight:
+            row_count += writer.write(in_flight.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+    return row_count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m geocoding_job",
+                                     description="Geocode the addresses of a CSV or Parquet file with the Bing "
+                                                 "Geocode Dataflow API")
+    parser.add_argument("input", help="A CSV or Parquet file with the columns id, streetAddress, postcode and "
+                                      "municipality")
+    parser.add_argument("output", help="The CSV or Parquet file the results are written to")
+    parser.add_argument("--input-format", choices=FORMATS, help="Guessed from the file extension by default")
+    parser.add_argument("--output-format", choices=FORMATS, help="Guessed from the file extension by default")
+    parser.add_argument("--delimiter", default=",", help="The field delimiter of a CSV input file")
+    parser.add_argument("--chunk-size", type=int, default=GeocodingJob.MAX_ENTITIES_PER_JOB,
+                        help="The number of rows geocoded in one Bing job")
+    parser.add_argument("--max-concurrent-jobs", type=int, default=4, help="The number of Bing jobs run at a time")
+    parser.add_argument("--result-schema", choices=sorted(RESULT_SCHEMAS), default="compact",
+                        help="compact writes just the ids, the geocoded addresses and the coordinates")
+    parser.add_argument("--bing-key", action="append",
+                        help="Read from the BING_API_KEY environment variable by default. Can be given several times "
+                             "together with --key-state to spread the jobs across several keys.")
+    parser.add_argument("--key-state", help="The path of a database of the per-key budgets, shared by all the "
+                                            "processes on the host that use the same keys")
+    parser.add_argument("--max-concurrent-jobs-per-key", type=int,
+                        default=KeyScheduler.DEFAULT_MAX_CONCURRENT_JOBS_PER_KEY,
+                        help="The number of jobs run at a time with one key, with --key-state")
+    parser.add_argument("--transactions-per-day", type=int,
+                        help="The daily transaction quota of every key, with --key-state")
+    parser.add_argument("--key-wait-timeout", type=float,
+                        help="The longest wait in seconds for a key with room for a job, with --key-state. "
+                             "Unlimited by default.")
+    parser.add_argument("--cache", help="The path of a result cache database shared between runs")
+    parser.add_argument("--deduplicate", action="store_true", help="Send identical addresses to Bing only once")
+    parser.add_argument("--payload-format", choices=GeocodingJob.INPUT_FORMATS, default="csv",
+                        help="The format of the data exchanged with Bing")
+    parser.add_argument("--compress-upload", action="store_true", help="Gzip the request payloads")
+    parser.add_argument("--max-poll-interval", type=float, default=PollingPolicy.DEFAULT_MAX_INTERVAL_SECONDS,
+                        help="The longest wait in seconds between two status checks of a job")
+    parser.add_argument("--dataflow-url", default=GeocodingJob.BING_DATAFLOW_URL, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    bing_keys = args.bing_key or [os.environ["BING_API_KEY"]]
+    if len(bing_keys) > 1 and not args.key_state:
+        parser.error("Several keys can only be used with --key-state")
+    key_scheduler = KeyScheduler(bing_keys, args.key_state, args.max_concurrent_jobs_per_key,
+                                 args.transactions_per_day) if args.key_state else None
+    row_count = geocode_file(args.input, args.output, bing_key=bing_keys[0], chunk_size=args.chunk_size,
+                             max_concurrent_jobs=args.max_concurrent_jobs, input_format=args.input_format,
+                             output_format=args.output_format, delimiter=args.delimiter,
+                             result_schema=RESULT_SCHEMAS[args.result_schema],
+                             cache=ResultCache(args.cache) if args.cache else None, deduplicate=args.deduplicate,
+                             compress_upload=args.compress_upload,
+                             # The input_format of the jobs would clash with the one of the input file.
+                             job_factory=functools.partial(GeocodingJob, input_format=args.payload_format),
+                             polling_policy=PollingPolicy(max_interval_seconds=args.max_poll_interval),
+                             dataflow_url=args.dataflow_url, key_scheduler=key_scheduler,
+                             key_wait_timeout_seconds=args.key_wait_timeout)
+    sys.stderr.write("Wrote {} rows to {}\n".format(row_count, args.output))
+    return 0
+
+
+# Private methods
+def _geocode_chunk(job_factory, chunk, bing_key, key_scheduler, key_wait_timeout_seconds, result_schema, job_kwargs):
+    """
+    Runs in a worker thread. The job is only created here so that its request payload is built in the thread too.
+
+    :return: The result dataframe of the chunk
+    """
+    return fetch_chunk_results(functools.partial(job_factory, **job_kwargs), chunk, result_schema, bing_key,
+                               key_scheduler, key_wait_timeout_seconds)
+
+
+def _guess_format(path):
+    """
+    :param path: A file path
+    :return: 'parquet' for .parquet and .pq files, otherwise 'csv'
+    """
+    return "parquet" if os.path.splitext(path)[1].lower() in (".parquet", ".pq") else "csv"
+
+
+def _require_pyarrow(path):
+    """
+    :param path: The path of a Parquet file about to be read or written
+    :return: The path
+    """
+    if pyarrow is None:
+        raise GeocodingJob.GeocodingException("pyarrow is required for reading and writing Parquet files such as "
+                                              "{}".format(path))
+    return path
+
+
+def _create_writer(path, output_format):
+    """
+    :param path: The path of the output file
+    :param output_format: 'csv' or 'parquet'
+    :return: A _CsvWriter or a _ParquetWriter
+    """
+    return _CsvWriter(path) if output_format == "csv" else _ParquetWriter(_require_pyarrow(path))
+
+
+class _CsvWriter:
+    """
+    Appends result dataframes to a CSV file. The columns of the first dataframe are used for the whole file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'w')
+        self._columns = None
+
+    def write(self, df):
+        """
+        :param df: A result dataframe
+        :return: The number of rows written
+        """
+        if self._columns is None:
+            self._columns = list(df.columns)
+            df.to_csv(self._file, index=False)
+        else:
+            df.reindex(columns=self._columns).to_csv(self._file, header=False, index=False)
+        return len(df)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+    """
+    Appends result dataframes to a Parquet file, one or more row groups per dataframe. The schema of the first
+    dataframe is used for the whole file.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._writer = None
+
+    def write(self, df):
+        """
+        :param df: A result dataframe
+        :return: The number of rows written
+        """
+        if self._writer is None:
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            self._writer = pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        else:
+            table = pyarrow.Table.from_pandas(df.reindex(columns=self._writer.schema.names),
+                                              schema=self._writer.schema, preserve_index=False)
+        self._writer.write_table(table)
+        return len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,94 @@
+import os
+import pandas
+from .geocoding_job import GeocodingJob
+from .multi_geocoding_job import MultiGeocodingJob
+
+
+class DeltaGeocodingJob:
+    """
+    Geocodes only what has changed in the input data since the previous run. The address fields of every input row
+    are hashed by id and compared against a snapshot of the previous run, which holds the hashes and the results of
+    its input. New ids, ids whose address has changed and ids that could not be geocoded last time are sent to
+    Bing; the results of the other ids are reused, and the ids no longer in the input are dropped. The snapshot is
+    then replaced with the full, updated results.
+
+    The ids sent to Bing are listed in new_ids and changed_ids, which includes the ids that failed last time, and
+    the dropped ones in deleted_ids.
+    """
+
+    def __init__(self, data, snapshot_path, **job_kwargs):
+        """
+        :param data: A pandas dataframe in the format accepted by GeocodingJob, of any length. The ids must be
+               unique.
+        :param snapshot_path: Path of the snapshot file. Created on the first run, when all the rows are geocoded.
+        :param job_kwargs: Other parameters of MultiGeocodingJob, e.g. bing_key or cache
+        """
+        if data['id'].duplicated().any():
+            raise GeocodingJob.GeocodingException("The ids of the input rows must be unique in delta mode")
+        self._snapshot_path = snapshot_path
+        self._job_kwargs = job_kwargs
+        self._hashes = self._address_hashes(data)
+
+        previous_hashes, self._previous_results = self._load_snapshot()
+        is_known = self._hashes.index.isin(previous_hashes.index)
+        # The hashes are compared as uint64 arrays, since reindexing would convert them to floats and lose bits.
+        is_unchanged = is_known.copy()
+        is_unchanged[is_known] = previous_hashes.loc[self._hashes.index[is_known]].values == \
+            self._hashes.values[is_known]
+        previous_ids = self._previous_results["Id"]
+        if "StatusCode" in self._previous_results.columns:
+            previous_ids = previous_ids[self._previous_results["StatusCode"] == "Success"]
+        is_unchanged &= self._hashes.index.isin(previous_ids)
+        self._changed_data = data[~is_unchanged]
+
+        self.new_ids = self._hashes.index[~is_known]
+        self.changed_ids = self._hashes.index[is_known & ~is_unchanged]
+        self.deleted_ids = previous_hashes.index[~previous_hashes.index.isin(self._hashes.index)]
+
+    # Public interface
+    def fetch_results(self, result_schema=None):
+        """
+        Geocodes the new and changed rows and updates the snapshot.
+
+        :param result_schema: An optional dict of column name to dtype, see GeocodingJob.fetch_results. The same
+               schema should be used on every run, since the results of the previous run are reused as they are.
+        :return: A dataframe of the results of all the input rows, both the reused and the fresh ones
+        """
+        fresh_results = MultiGeocodingJob(self._changed_data, **self._job_kwargs).fetch_results(result_schema) \
+            if len(self._changed_data) else pandas.DataFrame()
+        reused_results = self._previous_results[self._previous_results["Id"].isin(self._hashes.index) &
+                                                ~self._previous_results["Id"].isin(self._changed_data['id'])]
+        results = pandas.concat([reused_results, fresh_results], ignore_index=True, sort=False)
+        results = GeocodingJob._apply_result_schema(results, result_schema)
+        self._save_snapshot(results)
+        return results
+
+    # Private methods
+    @staticmethod
+    def _address_hashes(data):
+        """
+        :param data: The input dataframe
+        :return: A series of a hash of the normalized address fields of every row, indexed by id
+        """
+        payload_df = GeocodingJob._build_payload_df(data)
+        hashes = pandas.util.hash_pandas_object(payload_df.drop(columns=["Id"]), index=False)
+        return pandas.Series(hashes.values, index=payload_df["Id"].values)
+
+    def _load_snapshot(self):
+        """
+        :return: A tuple (hashes, results) of the previous run, empty if there is no snapshot yet
+        """
+        if not os.path.exists(self._snapshot_path):
+            return pandas.Series([], dtype="uint64"), pandas.DataFrame(columns=["Id"])
+        snapshot = pandas.read_pickle(self._snapshot_path)
+        return snapshot['hashes'], snapshot['results']
+
+    def _save_snapshot(self, results):
+        """
+        Replaces the snapshot atomically, so that an interrupted run leaves the previous snapshot intact.
+
+        :param results: The results of all the input rows
+        """
+        temporary_path = "{}.{}.tmp".format(self._snapshot_path, os.getpid())
+        pandas.to_pickle({'hashes': self._hashes, 'results': results}, temporary_path)
+        os.rename(temporary_path, self._snapshot_path)
@@ -1,11 +1,19 @@
 import enum
-import pandas
 import numpy
+import pandas
 import json
 import time
 import os
-import requests
-from StringIO import StringIO
+import uuid
+import zlib
+from collections import namedtuple, OrderedDict
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+from .polling_policy import PollingPolicy
+from .http_session import create_session, SpooledBody
+from .instrumentation import Instrumentation, MeteredStream
 
 
 class GeocodingJob:
@@ -27,6 +35,13 @@ class GeocodingJob:
         completed = "completed"
         error = "error"
 
+    # A handle to a submitted Bing job: the job id and the url its status can be read from.
+    JobHandle = namedtuple("JobHandle", ["job_id", "status_url"])
+
+    # The (connect, read) timeouts in seconds of the requests made in each phase of a job.
+    Timeouts = namedtuple("Timeouts", ["upload", "status", "download"])
+    DEFAULT_TIMEOUTS = Timeouts(upload=(10, 300), status=(10, 30), download=(10, 300))
+
     BING_CSV_HEADERS = ["Id", "GeocodeRequest/Culture", "GeocodeRequest/Query",
                         "GeocodeRequest/Address/AddressLine", "GeocodeRequest/Address/AdminDistrict",
                         "GeocodeRequest/Address/CountryRegion", "GeocodeRequest/Address/AdminDistrict2",
@@ -46,41 +61,410 @@ class GeocodingJob:
                         "GeocodeResponse/BoundingBox/SouthLatitude", "GeocodeResponse/QueryParseValues",
                         "GeocodeResponse/GeocodePoints", "StatusCode", "FaultReason", "TraceId"]
 
-    LOOP_WAIT_INTERVAL_SECONDS = 10
-
-    def __init__(self, data, bing_key=None):
+    # The request columns actually populated by _build_payload_df.
+    BING_POPULATED_REQUEST_HEADERS = ["Id", "GeocodeRequest/Culture", "GeocodeRequest/Address/AddressLine",
+                                      "GeocodeRequest/Address/CountryRegion", "GeocodeRequest/Address/Locality",
+                                      "GeocodeRequest/Address/PostalCode"]
+
+    # The header of the request CSV. Bing only returns the columns listed in the request header, so all the response
+    # columns are included but the request columns that are always empty are left out.
+    DEFAULT_PAYLOAD_HEADERS = [header for header in BING_CSV_HEADERS if header in BING_POPULATED_REQUEST_HEADERS or
+                               not header.startswith(("GeocodeRequest/", "ReverseGeocodeRequest/"))]
+
+    BING_DATAFLOW_URL = "http://spatial.virtualearth.net/REST/v1/Dataflows/Geocode"
+
+    # The columns of the input data of a job, see __init__.
+    INPUT_COLUMNS = ['id', 'streetAddress', 'postcode', 'municipality']
+
+    # Rows in the failed output with these status codes are considered transient failures worth retrying.
+    TRANSIENT_STATUS_CODES = ["ServerError", "ServiceUnavailable", "Timeout"]
+    DEFAULT_FAILED_ROW_RETRIES = 2
+
+    # The Bing Dataflow service accepts at most this many entities (rows) in a single geocoding job.
+    MAX_ENTITIES_PER_JOB = 200000
+
+    # A result schema (see fetch_results) that keeps the most useful response columns in compact dtypes.
+    COMPACT_RESULT_SCHEMA = {"Id": "int64",
+                             "GeocodeResponse/Address/AddressLine": "object",
+                             "GeocodeResponse/Address/AdminDistrict": "category",
+                             "GeocodeResponse/Address/Locality": "category",
+                             "GeocodeResponse/Address/PostalCode": "object",
+                             "GeocodeResponse/Address/FormattedAddress": "object",
+                             "GeocodeResponse/Confidence": "category",
+                             "GeocodeResponse/EntityType": "category",
+                             "GeocodeResponse/Point/Latitude": "float32",
+                             "GeocodeResponse/Point/Longitude": "float32",
+                             "GeocodeResponse/BoundingBox/EastLongitude": "float32",
+                             "GeocodeResponse/BoundingBox/NorthLatitude": "float32",
+                             "GeocodeResponse/BoundingBox/WestLongitude": "float32",
+                             "GeocodeResponse/BoundingBox/SouthLatitude": "float32",
+                             "StatusCode": "object",
+                             "FaultReason": "object"}
+
+    # The payload formats of the Dataflow API supported, see the input parameter of __init__.
+    INPUT_FORMATS = ["csv", "xml"]
+    _CONTENT_TYPES = {'csv': 'text/plain, charset=UTF-8', 'xml': 'application/xml, charset=UTF-8'}
+    _XML_NAMESPACE = "http://schemas.microsoft.com/search/local/2010/5/geocode"
+    # The elements of an XML entity whose text is a column of its own, as opposed to attributes.
+    _XML_TEXT_COLUMNS = ["StatusCode", "FaultReason", "TraceId"]
+
+    # The number of rows rendered at a time when the request payload is streamed to Bing.
+    PAYLOAD_CHUNK_ROWS = 10000
+
+    # The default number of result rows parsed at a time when the results are streamed.
+    RESULT_CHUNK_ROWS = 50000
+
+    def __init__(self, data, bing_key=None, cache=None, polling_policy=None, payload_headers=None, journal=None,
+                 job_name=None, deduplicate=False, session=None, timeouts=None, dataflow_url=BING_DATAFLOW_URL,
+                 instrumentation=None, failed_row_retries=DEFAULT_FAILED_ROW_RETRIES, compress_upload=False,
+                 input_format="csv"):
         """
         :param data: A pandas dataframe containing the columns 'id', 'streetAddress', 'municipality' and 'postcode'.
                      It is OK to have some missing values, but Bing *may* fail to geocode such entries.
         :param bing_key: A valid Bing spatial data API key. Can be omitted in which case an environment variable
                named BING_API_KEY is required. If both are nonexistent an exception is thrown.
+        :param cache: An optional result_cache.ResultCache. Rows found in the cache are answered from it and only
+               the rest are sent to Bing. The new results are stored in the cache.
+        :param polling_policy: A polling_policy.PollingPolicy that decides how long to wait between status
+               checks. A default PollingPolicy is used if omitted.
+        :param payload_headers: The columns of the request CSV sent to Bing, in order. Bing only returns the
+               columns listed here. Defaults to DEFAULT_PAYLOAD_HEADERS.
+        :param journal: An optional job_journal.JobJournal the status transitions of the job are recorded in, so
+               that the job can be resumed with GeocodingJob.resume if the process is restarted.
+        :param job_name: The name identifying the job in the journal. A random name is generated if omitted.
+        :param deduplicate: Whether to send rows with identical addresses to Bing only once. The results are copied
+               to all the original ids, so the result contains a row for each input row as usual.
+        :param session: A requests.Session to make the requests with, typically shared by many jobs so that they
+               share a connection pool. A session created by http_session.create_session is used if omitted.
+        :param timeouts: The GeocodingJob.Timeouts of the upload, status and download requests. Defaults to
+               DEFAULT_TIMEOUTS.
+        :param dataflow_url: The url of the geocode dataflow service, e.g. to run against a local stand-in server.
+        :param instrumentation: An optional instrumentation.Instrumentation that receives the timings, byte counts
+               and row counts of the phases of the job, e.g. an instrumentation.MetricsCollector.
+        :param failed_row_retries: How many times the rows Bing failed to geocode because of a transient fault are
+               resubmitted in a follow-up job. Rows that still fail are included in the results with their
+               StatusCode and FaultReason.
+        :param compress_upload: Whether to gzip the request payload on the fly as it is uploaded. The outputs are
+               always downloaded gzipped if the service supports it.
+        :param input_format: The payload format of the job, 'csv' or 'xml'. The results have the same columns in
+               either format.
         """
         bing_key = bing_key if bing_key is not None else os.environ["BING_API_KEY"]
         if bing_key is None:
             raise self.GeocodingException("You didn't provide a Bing API key. " +
                                           "Either provide the parameter or environment variable")
-        self._request_payload = self._build_bing_request_payload(data)
+        self.job_name = job_name if job_name is not None else uuid.uuid4().hex
+        self._instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        build_started = time.time()
+        payload_df = self._build_payload_df(data)
+        self._duplicate_ids = None
+        if deduplicate:
+            payload_df, self._duplicate_ids = self._deduplicate_payload_df(payload_df)
+        self._cache = cache
+        self._cached_results = None
+        if cache is not None:
+            self._cached_results, payload_df = cache.lookup(payload_df)
+        self._payload_df = payload_df
+        self._instrumentation.timing(self, "payload_build", time.time() - build_started)
+        self._payload_headers = payload_headers if payload_headers is not None else self.DEFAULT_PAYLOAD_HEADERS
         self._bing_key = bing_key
+        self._session = session if session is not None else create_session()
+        self._timeouts = timeouts if timeouts is not None else self.DEFAULT_TIMEOUTS
         self.status = self.GCStatus.initialized
-        self._create_bing_job_url = "http://spatial.virtualearth.net/REST/v1/Dataflows/Geocode?input=csv" +\
-                                   "&key={}".format(self._bing_key)
+        self._journal = journal
+        self.handle = None
+        self._resource = None
+        self._polling_policy = polling_policy if polling_policy is not None else PollingPolicy()
+        self._poll_attempts = 0
+        self._submitted_at = None
+        self._failed_row_retries = failed_row_retries
+        # The follow-up job the rows failed by transient faults are resubmitted in, see collect_chunks.
+        self.retry_job = None
+        self._compress_upload = compress_upload
+        if input_format not in self.INPUT_FORMATS:
+            raise self.GeocodingException("The input format must be one of {}".format(", ".join(self.INPUT_FORMATS)))
+        self._input_format = input_format
+        self._dataflow_url = dataflow_url
+        self._create_bing_job_url = "{}?input={}&key={}".format(dataflow_url, input_format, self._bing_key)
 
     # Public interface
-    def fetch_results(self):
-        """
-        The public method that coordinates the process of fetching the results from Bing.
-        :return: A dataframe containing all of the request and response columns
-        """
-        r = self._create_geocoding_job()
-        response = self._loop_for_results(r)
-        if not self.status == self.GCStatus.result_request_completed:
-            self.status = self.GCStatus.error
-            raise self.GeocodingException("Fetching the results failed somehow")
-        df = self._process_csv_response(response)
-        self.status = self.GCStatus.completed
-        return df
+    def fetch_results(self, result_schema=None):
+        """
+        The public method that coordinates the process of fetching the results from Bing. Blocks until the
+        results are available, including those of the follow-up jobs of resubmitted rows.
+
+        :param result_schema: An optional dict of column name to dtype, e.g. COMPACT_RESULT_SCHEMA. If given, only
+               these columns are parsed from the Bing response, with the given dtypes.
+        :return: A dataframe containing all of the request and response columns, or the columns of result_schema
+        """
+        if self.status == self.GCStatus.initialized:
+            self.submit()
+        self._loop_for_results()
+        df = self.collect(result_schema)
+        if self.retry_job is None:
+            return df
+        df = pandas.concat([df, self.retry_job.fetch_results(result_schema)], ignore_index=True, sort=False)
+        # Categoricals with different categories are concatenated as objects, so the dtypes are restored here.
+        return self._apply_result_schema(df, result_schema)
+
+    @classmethod
+    def resume(cls, journal, job_name, bing_key=None, polling_policy=None, session=None, timeouts=None,
+               input_format="csv"):
+        """
+        Recreates a job from the last state recorded in a journal, e.g. after the process was restarted while
+        waiting for Bing. A job that was still pending at Bing is polled again and the output of a job that Bing
+        had already completed is downloaded again. Nothing is resubmitted to Bing. Continue by calling
+        fetch_results, or poll and collect.
+
+        Only what Bing returns can be recovered, so jobs that left out duplicate rows or answered rows from a cache
+        cannot be resumed, and rows Bing failed to geocode are returned as failures rather than resubmitted.
+
+        :param journal: The job_journal.JobJournal the job was recorded in
+        :param job_name: The name of the job in the journal
+        :param bing_key: A valid Bing spatial data API key, see __init__
+        :param polling_policy: An optional polling_policy.PollingPolicy, see __init__
+        :param session: An optional requests.Session, see __init__
+        :param timeouts: Optional GeocodingJob.Timeouts, see __init__
+        :param input_format: The payload format the job was created with, see __init__
+        :return: A GeocodingJob in the pending or bing_completed status
+        """
+        entry = journal.last_entry(job_name)
+        if entry is None or entry['status_url'] is None:
+            raise cls.GeocodingException("The job {} was never submitted to Bing, create it again".format(job_name))
+        if entry['status'] == 'completed':
+            raise cls.GeocodingException("The job {} has already been completed".format(job_name))
+        if entry.get('duplicate_rows') or entry.get('cached_rows'):
+            raise cls.GeocodingException("The job {} left out duplicate or cached rows, which cannot be restored "
+                                         "from the journal; create it again".format(job_name))
+
+        job = cls(pandas.DataFrame(columns=cls.INPUT_COLUMNS), bing_key=bing_key,
+                  polling_policy=polling_policy, journal=journal, job_name=job_name, session=session,
+                  timeouts=timeouts, input_format=input_format)
+        job.handle = cls.JobHandle(entry['job_id'], entry['status_url'])
+        links = [{'role': 'self', 'url': entry['status_url']}]
+        if entry['output_links']:
+            links.extend({'role': 'output', 'name': name, 'url': url} for name, url in entry['output_links'].items())
+            job._resource = {'status': 'Completed', 'links': links}
+            job._set_status(cls.GCStatus.bing_completed)
+        else:
+            job._resource = {'status': 'Pending', 'links': links}
+            job._set_status(cls.GCStatus.pending)
+        return job
+
+    def submit(self):
+        """
+        Creates the Bing geocoding job without waiting for it to complete.
+
+        :return: A JobHandle for the created job, or None if all the rows were answered from the cache and no
+                 job was needed
+        """
+        if self.status != self.GCStatus.initialized:
+            raise self.GeocodingException("The job has already been submitted")
+        if self._payload_df.empty and self._cached_results is not None:
+            self._set_status(self.GCStatus.bing_completed)
+            return None
+        self._resource = self._read_resource(self._create_geocoding_job())
+        self._submitted_at = time.time()
+        self.handle = self.JobHandle(self._resource.get('id'), self._resource['links'][0]['url'])
+        self._set_status(self.GCStatus.job_created)
+        return self.handle
+
+    def poll(self):
+        """
+        Checks the status of the submitted job once, without blocking.
+
+        :return: True if Bing has completed the job and the results can be collected, False otherwise
+        """
+        if self.status == self.GCStatus.initialized:
+            raise self.GeocodingException("The job has not been submitted yet")
+        if self.status == self.GCStatus.error:
+            raise self.GeocodingException("The job has failed")
+        if self.status not in (self.GCStatus.job_created, self.GCStatus.pending):
+            return True
+        status = self._read_status(self._resource)
+        if status != 'Completed':
+            self._poll_attempts += 1
+            poll_started = time.time()
+            self._resource = self._read_resource(self._read_new_response(self.handle.status_url))
+            self._instrumentation.timing(self, "poll", time.time() - poll_started)
+            status = self._read_status(self._resource)
+        if status == 'Completed':
+            if self._submitted_at is not None:
+                self._instrumentation.timing(self, "queue_wait", time.time() - self._submitted_at)
+            self._instrumentation.count(self, "rows_failed", self._resource.get('failedEntityCount', 0))
+            self._set_status(self.GCStatus.bing_completed)
+            return True
+        if status == 'Aborted':
+            self._set_status(self.GCStatus.error)
+            raise self.GeocodingException("Bing aborted the job {}".format(self.handle.job_id))
+        self._set_status(self.GCStatus.pending)
+        return False
+
+    def next_poll_interval(self):
+        """
+        :return: The number of seconds to wait before the next poll, as decided by the polling policy based on
+                 the number of polls so far, the job size and the progress reported by Bing
+        """
+        elapsed_seconds = time.time() - self._submitted_at if self._submitted_at is not None else None
+        return self._polling_policy.interval(self._poll_attempts, len(self._payload_df), self._resource,
+                                             elapsed_seconds)
+
+    def resubmitted_row_count(self):
+        """
+        :return: The number of rows resubmitted in follow-up jobs so far, counting those of every follow-up job in
+                 the chain, see collect_chunks
+        """
+        row_count = 0
+        retry_job = self.retry_job
+        while retry_job is not None:
+            row_count += len(retry_job._payload_df)
+            retry_job = retry_job.retry_job
+        return row_count
+
+    def collect(self, result_schema=None):
+        """
+        Downloads and parses the results of a job that Bing has completed. The results of the rows resubmitted
+        after transient faults are left to self.retry_job, see collect_chunks.
+
+        :param result_schema: An optional dict of column name to dtype, see fetch_results
+        :return: A dataframe containing all of the request and response columns, or the columns of result_schema
+        """
+        frames = list(self.collect_chunks(chunksize=None, result_schema=result_schema))
+        if len(frames) == 1:
+            return frames[0]
+        df = pandas.concat(frames, ignore_index=True, sort=False)
+        # Categoricals with different categories are concatenated as objects, so the dtypes are restored here.
+        return self._apply_result_schema(df, result_schema)
+
+    def collect_chunks(self, chunksize=RESULT_CHUNK_ROWS, result_schema=None):
+        """
+        Streams the results of a job that Bing has completed. The output is read from the network and parsed
+        incrementally, so only one chunk of the results is held in memory at a time.
+
+        :param chunksize: The number of rows in each yielded dataframe. If None, the whole output is parsed into a
+               single dataframe.
+        :param result_schema: An optional dict of column name to dtype, see fetch_results. Note that the categories
+               of categorical columns are chunk specific.
+        :return: A generator of dataframes containing the request and response columns, or the columns of
+                 result_schema
+
+        After the succeeded output, the failed output is downloaded as well. Rows that failed because of a transient
+        fault are resubmitted in a follow-up job, which is not waited for here but left submitted in self.retry_job
+        for the caller to poll and collect like any other job.
+        """
+        # A download interrupted by a network error can be started over.
+        if self.status not in (self.GCStatus.bing_completed, self.GCStatus.result_request_completed):
+            raise self.GeocodingException("The job has not been completed by Bing")
+        if not self._payload_df.empty or self._cached_results is None:
+            response = self._read_new_response(self._output_url("succeeded"), stream=True)
+            self._set_status(self.GCStatus.result_request_completed)
+            try:
+                stream = MeteredStream(response.raw)
+                # The output is parsed as it is downloaded, so the parse time is what is left of the time spent
+                # in the parser after subtracting the time spent waiting for the network.
+                parse_seconds = 0.0
+                row_count = 0
+                parse_started = time.time()
+                # The cache needs all the columns, so the schema is only applied after storing the results.
+                frames = self._process_response(stream, chunksize, result_schema, all_columns=self._cache is not None)
+                frames = iter([frames] if chunksize is None else frames)
+                while True:
+                    df = next(frames, None)
+                    parse_seconds += time.time() - parse_started
+                    if df is None:
+                        break
+                    row_count += len(df)
+                    if self._cache is not None:
+                        self._cache.store(self._payload_df, df)
+                        df = self._apply_result_schema(df, result_schema)
+                    yield self._fan_out_duplicates(df)
+                    parse_started = time.time()
+                # The bytes pulled over the wire, i.e. before decompression.
+                self._instrumentation.timing(self, "download", stream.seconds, response.raw.tell())
+                self._instrumentation.timing(self, "parse", parse_seconds - stream.seconds)
+                self._instrumentation.count(self, "rows_succeeded", row_count)
+            finally:
+                response.close()
+            if self._output_url("failed") is not None:
+                failed = self._collect_failed_rows(result_schema)
+                if not failed.empty:
+                    yield self._fan_out_duplicates(failed)
+        if self._cached_results is not None and (self._payload_df.empty or not self._cached_results.empty):
+            yield self._fan_out_duplicates(self._apply_result_schema(self._cached_results, result_schema))
+        self._set_status(self.GCStatus.completed)
+
+    def collect_to_file(self, path, chunksize=RESULT_CHUNK_ROWS):
+        """
+        Streams the results of a job that Bing has completed into a CSV file, one chunk at a time.
+
+        :param path: The path of the CSV file to write
+        :param chunksize: The number of rows parsed and written at a time
+        :return: The number of result rows written
+        """
+        columns = None
+        row_count = 0
+        with open(path, 'w') as result_file:
+            for df in self.collect_chunks(chunksize):
+                if columns is None:
+                    columns = df.columns
+                    df.to_csv(result_file, header=True, index=False)
+                else:
+                    df.reindex(columns=columns).to_csv(result_file, header=False, index=False)
+                row_count += len(df)
+        return row_count
 
     # Private methods
+    @classmethod
+    def _from_payload_df(cls, payload_df, **kwargs):
+        """
+        Creates a job for an already built request payload, e.g. for resubmitting some rows of another job.
+
+        :param payload_df: A dataframe as returned by _build_payload_df
+        :param kwargs: Other parameters of __init__
+        :return: A GeocodingJob
+        """
+        job = cls(pandas.DataFrame(columns=cls.INPUT_COLUMNS), **kwargs)
+        job._payload_df = payload_df
+        return job
+
+    def _output_url(self, name):
+        """
+        :param name: The name of a Bing output, 'succeeded' or 'failed'
+        :return: The url of the output of the completed job, or None if Bing did not produce such an output
+        """
+        return next((link['url'] for link in self._resource['links'] if
+                     (link['role'] == 'output' and link['name'] == name)), None)
+
+    def _collect_failed_rows(self, result_schema):
+        """
+        Downloads the failed output of the job and resubmits the rows with transient faults in a follow-up job,
+        as long as there are retries left. The follow-up job is submitted and stored in self.retry_job.
+
+        :param result_schema: An optional dict of column name to dtype, see fetch_results
+        :return: A dataframe of the rows that could not be geocoded and were not resubmitted
+        """
+        response = self._read_new_response(self._output_url("failed"), stream=True)
+        try:
+            failed = self._process_response(response.raw, result_schema=result_schema, all_columns=True)
+        finally:
+            response.close()
+
+        retry = failed["StatusCode"].isin(self.TRANSIENT_STATUS_CODES) & failed["Id"].isin(self._payload_df["Id"])
+        if self._failed_row_retries > 0 and retry.any():
+            retry_job = self._from_payload_df(
+                self._payload_df[self._payload_df["Id"].isin(failed["Id"][retry])], bing_key=self._bing_key,
+                cache=self._cache, polling_policy=self._polling_policy, payload_headers=self._payload_headers,
+                journal=self._journal, job_name="{}-retry".format(self.job_name), session=self._session,
+                timeouts=self._timeouts, dataflow_url=self._dataflow_url, instrumentation=self._instrumentation,
+                failed_row_retries=self._failed_row_retries - 1, compress_upload=self._compress_upload,
+                input_format=self._input_format)
+            # The results of the follow-up job are fanned out to the duplicates of its rows like those of this job.
+            retry_job._duplicate_ids = self._duplicate_ids
+            retry_job.submit()
+            self.retry_job = retry_job
+            failed = failed[~retry]
+        return self._apply_result_schema(failed, result_schema)
+
     def _create_geocoding_job(self):
         """
         Creates the geocoding job.
@@ -88,23 +472,131 @@ class GeocodingJob:
         :return: a requests module response object
         """
 
-        response = requests.post(self._create_bing_job_url, data=self._request_payload,
-                                 headers={'content-type': 'text/plain, charset=UTF-8'})
-        self.status = self.GCStatus.job_created
+        upload_started = time.time()
+        self._upload_byte_count = 0
+        # The payload is rendered piece by piece into a spooled body, which is sent with a Content-Length so that
+        # the upload timeouts apply; requests ignores the timeout of a body streamed from a generator.
+        if self._input_format == "xml":
+            payload = self._build_bing_xml_request_payload(self._payload_df)
+        else:
+            payload = self._build_bing_request_payload(self._payload_df, self._payload_headers)
+        headers = {'content-type': self._CONTENT_TYPES[self._input_format]}
+        if self._compress_upload:
+            payload = self._gzip_pieces(payload)
+            headers['content-encoding'] = 'gzip'
+        body = SpooledBody(self._count_upload_bytes(payload))
+        response = self._session.post(self._create_bing_job_url, data=body, headers=headers,
+                                      timeout=self._timeouts.upload)
+        self._instrumentation.timing(self, "upload", time.time() - upload_started, self._upload_byte_count)
+        self._instrumentation.count(self, "rows_submitted", len(self._payload_df))
         return response
 
+    def _count_upload_bytes(self, pieces):
+        """
+        Passes the pieces of the request payload through, counting their bytes in self._upload_byte_count.
+
+        :param pieces: A generator of strings
+        :return: A generator of the same strings
+        """
+        for piece in pieces:
+            self._upload_byte_count += len(piece)
+            yield piece
+
     @staticmethod
-    def _build_bing_request_payload(df):
+    def _gzip_pieces(pieces):
+        """
+        Compresses a stream of strings into a gzip stream piece by piece, so that the whole payload is never held in
+        memory either compressed or uncompressed.
+
+        :param pieces: A generator of strings
+        :return: A generator of the gzip compressed bytes
+        """
+        # A window size of 16 + MAX_WBITS makes zlib write the gzip header and trailer.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for piece in pieces:
+            compressed = compressor.compress(piece)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def _set_status(self, status):
         """
-        Converts a dataframe with all the Bing-formatted input data into a properly formatted Bing CSV payload.
+        Updates the status of the job and records the transition in the journal, if there is one.
 
-        :param df: A formatted dataframe containing the columns relevant for Bing CSV requests
-        :return: A Bing request csv formed from the input df
+        :param status: The new GCStatus
+        """
+        if status == self.status:
+            return
+        self.status = status
+        if self._journal is not None:
+            links = self._resource['links'] if self._resource is not None else []
+            self._journal.record(self.job_name, status,
+                                 job_id=self.handle.job_id if self.handle is not None else None,
+                                 status_url=self.handle.status_url if self.handle is not None else None,
+                                 output_links={link['name']: link['url'] for link in links if link['role'] == 'output'},
+                                 duplicate_rows=len(self._duplicate_ids) if self._duplicate_ids is not None else 0,
+                                 cached_rows=len(self._cached_results) if self._cached_results is not None else 0)
+
+    @staticmethod
+    def _build_bing_request_payload(payload_df, headers):
+        """
+        Converts a dataframe with all the Bing-formatted input data into a properly formatted Bing CSV payload. The
+        payload is rendered PAYLOAD_CHUNK_ROWS rows at a time so that the whole of it is never held in memory.
+
+        :param payload_df: A formatted dataframe containing the columns relevant for Bing CSV requests, as returned
+               by _build_payload_df
+        :param headers: The columns of the request CSV, in order. Columns missing from payload_df are left empty.
+        :return: A generator of consecutive pieces of the Bing request csv formed from the input df
         """
         # Modifications needed to make this Python 3.x compatible; also, the ID probaby needs to be a little bit
         # more unique and aso persisted somewhere.
-        csv = GeocodingJob._build_payload_df(df).to_csv(sep=",", header=True, index=False)
-        return "Bing Spatial Data Services, 2.0\n" + csv
+        yield "Bing Spatial Data Services, 2.0\n" + ",".join(headers) + "\n"
+        for start in range(0, len(payload_df), GeocodingJob.PAYLOAD_CHUNK_ROWS):
+            chunk = payload_df.iloc[start:start + GeocodingJob.PAYLOAD_CHUNK_ROWS]
+            yield chunk.reindex(columns=headers, fill_value="").to_csv(sep=",", header=False, index=False)
+
+    @classmethod
+    def _build_bing_xml_request_payload(cls, payload_df):
+        """
+        Converts a dataframe with all the Bing-formatted input data into a Bing XML payload. Like the CSV payload,
+        it is rendered PAYLOAD_CHUNK_ROWS rows at a time, and the entities of a chunk are built with vectorized
+        string operations rather than row by row.
+
+        :param payload_df: A formatted dataframe as returned by _build_payload_df. Every 'GeocodeRequest/X/Y'
+               column becomes the attribute Y of the element X of the GeocodeRequest. Payloads with
+               'ReverseGeocodeRequest/X/Y' columns are rendered as ReverseGeocodeRequests in the same way.
+        :return: A generator of consecutive pieces of the Bing request XML
+        """
+        yield '<?xml version="1.0" encoding="utf-8"?>\n<GeocodeFeed xmlns="{}" Version="2.0">\n'.format(
+            cls._XML_NAMESPACE)
+        request = "ReverseGeocodeRequest" if any(column.startswith("ReverseGeocodeRequest/")
+                                                 for column in payload_df.columns) else "GeocodeRequest"
+        elements = OrderedDict()
+        for column in payload_df.columns:
+            parts = column.split("/")
+            if len(parts) == 3 and parts[0] == request:
+                elements.setdefault(parts[1], []).append((parts[2], column))
+        for start in range(0, len(payload_df), cls.PAYLOAD_CHUNK_ROWS):
+            chunk = payload_df.iloc[start:start + cls.PAYLOAD_CHUNK_ROWS]
+            xml = '<GeocodeEntity Id="' + cls._escape_xml(chunk["Id"]) + '"><' + request + ' Culture="' + \
+                cls._escape_xml(chunk["GeocodeRequest/Culture"]) + '">'
+            for element, attributes in elements.items():
+                xml += "<" + element
+                for attribute, column in attributes:
+                    xml += " " + attribute + '="' + cls._escape_xml(chunk[column]) + '"'
+                xml += " />"
+            xml += "</" + request + "></GeocodeEntity>\n"
+            yield "".join(xml.values)
+        yield "</GeocodeFeed>\n"
+
+    @staticmethod
+    def _escape_xml(values):
+        """
+        :param values: A series
+        :return: The values as strings escaped for XML attributes, with missing values as empty strings
+        """
+        return values.astype(str).where(values.notnull(), "").str.replace("&", "&amp;").str.replace(
+            "<", "&lt;").str.replace(">", "&gt;").str.replace('"', "&quot;")
 
     @staticmethod
     def _build_payload_df(raw_data):
@@ -112,24 +604,53 @@ class GeocodingJob:
         From the raw input dataframe, build a version that can be used to construct Bing request CSV
 
         :param raw_data: The raw input data containing id, streetAddress, municipality and postcode for each record.
-        :return: a dataframe formulated to contain Bing headers so that a Bing format payload can be formed from this
-                 df by a simple pandas.to_csv
-        """
-
-        # TODO: maybe the unused ones can be dropped to remove bloat and just the relevant ones included
-        # TODO: in the structure, need to check this out.
-        # TODO: An initial observation is that the csv response will only include the fields listed in the request,
-        # TODO:  which is kind of silly, no?
-        df = pandas.DataFrame(columns=GeocodingJob.BING_CSV_HEADERS)
-        df['Id'] = raw_data['id']
-        df["GeocodeRequest/Address/PostalCode"] = raw_data['postcode'].apply(lambda x: str(x).zfill(5))
-        df["GeocodeRequest/Culture"] = 'fi_FI'
-        df["GeocodeRequest/Address/AddressLine"] = raw_data['streetAddress'].replace(numpy.nan, "", regex=True)
-        df["GeocodeRequest/Address/Locality"] = raw_data['municipality'].replace(numpy.nan, "", regex=True)
-
-        # For now, hard code country instead of reading it from source data.
-        df["GeocodeRequest/Address/CountryRegion"] = 'Finland'
-        return df
+        :return: a dataframe containing the populated Bing request columns (BING_POPULATED_REQUEST_HEADERS), from
+                 which a Bing format payload can be rendered by _build_bing_request_payload
+        """
+        postcodes = raw_data['postcode']
+        # Postcodes may have been parsed as numbers, dropping the leading zeros, or as floats if some are missing.
+        padded_postcodes = postcodes.astype(str).str.replace(r"\.0$", "").str.zfill(5).where(postcodes.notnull(), "")
+
+        # For now, hard code culture and country instead of reading them from source data.
+        return pandas.DataFrame({"Id": raw_data['id'],
+                                 "GeocodeRequest/Culture": 'fi_FI',
+                                 "GeocodeRequest/Address/AddressLine": raw_data['streetAddress'].fillna(""),
+                                 "GeocodeRequest/Address/CountryRegion": 'Finland',
+                                 "GeocodeRequest/Address/Locality": raw_data['municipality'].fillna(""),
+                                 "GeocodeRequest/Address/PostalCode": padded_postcodes},
+                                index=raw_data.index, columns=GeocodingJob.BING_POPULATED_REQUEST_HEADERS)
+
+    @staticmethod
+    def _deduplicate_payload_df(payload_df):
+        """
+        Collapses the payload rows with identical address fields into one request. The Id of the first such row is
+        used for the request.
+
+        :param payload_df: A dataframe as returned by _build_payload_df
+        :return: A tuple (unique_payload_df, duplicate_ids) where duplicate_ids is a dataframe mapping the request
+                 'Id' of each dropped row to its 'original_id'
+        """
+        address_columns = [column for column in payload_df.columns if column != "Id"]
+        is_duplicate = payload_df.duplicated(subset=address_columns)
+        request_ids = payload_df.groupby(address_columns, sort=False)["Id"].transform("first")
+        duplicate_ids = pandas.DataFrame({"Id": request_ids[is_duplicate],
+                                          "original_id": payload_df["Id"][is_duplicate]})
+        return payload_df[~is_duplicate], duplicate_ids
+
+    def _fan_out_duplicates(self, df):
+        """
+        Copies the results of deduplicated requests to all the original ids the requests stood for.
+
+        :param df: A result dataframe
+        :return: The result dataframe with a row added for each duplicate dropped by _deduplicate_payload_df
+        """
+        if self._duplicate_ids is None or self._duplicate_ids.empty:
+            return df
+        if "Id" not in df.columns:
+            raise self.GeocodingException("The results of a deduplicated job must include the Id column")
+        copies = df.merge(self._duplicate_ids, on="Id")
+        copies["Id"] = copies.pop("original_id")
+        return pandas.concat([df, copies], ignore_index=True, sort=False)[df.columns]
 
     @staticmethod
     def _read_resource(r):
@@ -153,58 +674,191 @@ class GeocodingJob:
         """
         return resource_json['status']
 
-    def _read_new_response(self, keyless_url):
+    def _read_new_response(self, keyless_url, stream=False):
         """
         Read a new iteration of the url. We expect that the key is not part of the url but rather we
         concatenate it to the url here. Returns a requests response object.
 
         :param keyless_url: A Bing url, read from the resource JSON
+        :param stream: Whether to leave the response body unread so that it can be consumed as a stream from
+               response.raw. Output downloads are streamed and use the download timeouts, status reads the status
+               timeouts.
         :return: a requests module response object
         """
-        return requests.get("{}?key={}".format(keyless_url, self._bing_key))
+        response = self._session.get("{}?key={}".format(keyless_url, self._bing_key), stream=stream,
+                                     headers={'accept-encoding': 'gzip, deflate'},
+                                     timeout=self._timeouts.download if stream else self._timeouts.status)
+        if stream:
+            # Let urllib3 decompress the body as it is read if the server sent it compressed.
+            response.raw.decode_content = True
+        return response
 
-    def _loop_for_results(self, r):
+    def _loop_for_results(self):
         """
-        Keeps waiting for the results for a particular geocoding job to be available.
-
-        :param r: a requests module response object containing status information
-        :return: a requests module response object containing actual geocoded data
+        Keeps waiting for a submitted geocoding job to be completed by Bing. Blocks the calling thread; use poll
+        directly, or a job_coordinator.JobCoordinator, to wait for several jobs at once.
 
         TODO: No error checking is performed so if something goes wrong, an uncaught exception will be thrown.
-        TODO: This is currently bit of a hack and only suitable for situations where it is OK for the
-        TODO: results waiting to block subsequent processing. It may be feasible to use some other async method
-        TODO: in some scenarios. This will do for us for the time being, however.
         """
+        while not self.poll():
+            time.sleep(self.next_poll_interval())
 
-        resource = self._read_resource(r)
-        status = self._read_status(resource)
+    def _process_response(self, stream, chunksize=None, result_schema=None, all_columns=False):
+        """
+        Converts an output of the job into dataframes, see _process_csv_response and _process_xml_response.
 
-        # TODO: check if this is robust enough... find the resources key and corresponding value (array), pick the
-        # TODO: first element.
+        :param all_columns: Whether to parse all the columns even though a result_schema is given, e.g. to store
+               the results in the cache. The string columns of the schema are still parsed as strings, but the
+               schema is left for the caller to apply.
+        """
+        if self._input_format == "xml":
+            if all_columns or result_schema is None:
+                columns, applied_schema = self._payload_headers, None
+                string_columns = self._string_dtypes(result_schema)
+            else:
+                columns = string_columns = list(result_schema)
+                applied_schema = result_schema
+            frames = self._process_xml_response(stream, columns, chunksize or self.RESULT_CHUNK_ROWS, string_columns)
+            if chunksize is not None:
+                return (self._apply_result_schema(df, applied_schema) for df in frames)
+            df = next(frames)
+            return self._apply_result_schema(pandas.concat([df] + list(frames), ignore_index=True), applied_schema)
+        if all_columns:
+            return self._process_csv_response(stream, chunksize, dtype=self._string_dtypes(result_schema))
+        return self._process_csv_response(stream, chunksize, result_schema)
 
-        print("Just about to enter the fetching loop")
-        while status != 'Completed':
-            if status == 'Pending':
-                self.status == self.GCStatus.pending
-            time.sleep(self.LOOP_WAIT_INTERVAL_SECONDS)
-            resource = self._read_resource(self._read_new_response(resource['links'][0]['url']))
-            status = self._read_status(resource)
+    @staticmethod
+    def _string_dtypes(result_schema):
+        """
+        :param result_schema: A dict of column name to dtype, or None
+        :return: The part of the schema with non-numeric dtypes. Parsing these columns in their dtypes keeps e.g.
+                 postal codes from being read as numbers, while the numeric columns can still be parsed at full
+                 precision.
+        """
+        return {column: dtype for column, dtype in (result_schema or {}).items()
+                if not pandas.api.types.is_numeric_dtype(pandas.api.types.pandas_dtype(dtype))}
 
-        self.status = self.GCStatus.bing_completed
-        response = self._read_new_response(next(link['url'] for link in resource['links'] if
-                                           (link['role'] == 'output' and link['name'] == "succeeded")))
-        self.status = self.GCStatus.result_request_completed
-        return response
+    @staticmethod
+    def _process_csv_response(stream, chunksize=None, result_schema=None, dtype=None):
+        """
+        Converts the CSV response from Bing into a dataframe. The body is parsed directly from the response stream,
+        so it is never copied into memory as a whole.
+
+        :param stream: a file-like object streaming the successful Bing CSV response payload, e.g. the raw body of
+               a requests module response object requested with stream=True
+        :param chunksize: If given, the payload is parsed incrementally in chunks of this many rows
+        :param result_schema: An optional dict of column name to dtype. If given, only these columns are parsed.
+        :param dtype: An optional dict of column name to dtype to parse all the columns with, if result_schema is
+               not given
+        :return: a dataframe formulated from the payload, or an iterator of dataframes if chunksize was given
+        """
+        return pandas.read_csv(stream, header=1, chunksize=chunksize,
+                               usecols=list(result_schema) if result_schema is not None else None,
+                               dtype=result_schema if result_schema is not None else dtype)
+
+    @classmethod
+    def _process_xml_response(cls, stream, columns, chunksize, string_columns=()):
+        """
+        Converts the XML response from Bing into dataframes with the same columns as the CSV response. The body is
+        parsed incrementally with iterparse, and every entity is cleared from the tree once its values have been
+        copied into the preallocated columns of the current chunk, so memory use does not depend on the size of the
+        response.
+
+        :param stream: a file-like object streaming the Bing XML response payload
+        :param columns: The names of the columns to fill, as in the CSV response
+        :param chunksize: The number of rows in each dataframe
+        :param string_columns: The columns whose values are left as strings. The other columns are converted to
+               numbers as read_csv would, if all their values are numeric.
+        :return: A generator of dataframes, at least one even if the response has no entities
+        """
+        namespace = "{" + cls._XML_NAMESPACE + "}"
+        wanted = set(columns)
+        chunk = cls._empty_xml_chunk(columns, chunksize)
+        row = 0
+        yielded = False
+        root = None
+        for event, element in ElementTree.iterparse(stream, events=("start", "end")):
+            if root is None:
+                root = element
+            if event != "end" or element.tag != namespace + "GeocodeEntity":
+                continue
+            values = {"Id": element.get("Id")}
+            for child in element:
+                tag = child.tag[len(namespace):]
+                # The CSV output only has the first response of an entity.
+                if tag != "GeocodeResponse" or "GeocodeResponse" not in values:
+                    values[tag] = True
+                    cls._read_xml_element(child, tag, namespace, values)
+            if "GeocodeResponse/GeocodePoints" in values:
+                values["GeocodeResponse/GeocodePoints"] = json.dumps(values["GeocodeResponse/GeocodePoints"])
+            for column, value in values.items():
+                if column in wanted:
+                    chunk[column][row] = value
+            row += 1
+            # Drops the entity, and the references the root keeps to the already parsed entities.
+            element.clear()
+            root.clear()
+            if row == chunksize:
+                yield cls._xml_chunk_df(chunk, columns, row, string_columns)
+                yielded = True
+                chunk = cls._empty_xml_chunk(columns, chunksize)
+                row = 0
+        if row or not yielded:
+            yield cls._xml_chunk_df(chunk, columns, row, string_columns)
+
+    @classmethod
+    def _read_xml_element(cls, element, path, namespace, values):
+        """
+        Copies the values of an element of an XML entity and its descendants into a dict keyed by the CSV column
+        names, in which the attribute Y of the element GeocodeResponse/X is the column 'GeocodeResponse/X/Y'.
+
+        :param element: An element of an entity
+        :param path: The path of the element from the entity, without namespaces
+        :param namespace: The namespace of the tags in the curly brace notation of ElementTree
+        :param values: The dict to update
+        """
+        if path in cls._XML_TEXT_COLUMNS:
+            values[path] = element.text
+        elif path == "GeocodeResponse/GeocodePoint":
+            values.setdefault("GeocodeResponse/GeocodePoints", []).append(dict(element.attrib))
+        else:
+            for attribute, value in element.attrib.items():
+                values[path + "/" + attribute] = value
+            for child in element:
+                cls._read_xml_element(child, path + "/" + child.tag[len(namespace):], namespace, values)
 
     @staticmethod
-    def _process_csv_response(response):
+    def _empty_xml_chunk(columns, chunksize):
         """
-        Converts the CSV response from Bing into a dataframe
+        :return: A dict of a preallocated array of missing values for every column
+        """
+        return {column: numpy.full(chunksize, None, dtype=object) for column in columns}
 
-        :param response: a requests module response object containing the successful Bing CSV response payload
-        :return: a dataframe formulated from the payload
+    @staticmethod
+    def _xml_chunk_df(chunk, columns, row_count, string_columns):
+        """
+        :param chunk: A dict of the column arrays of a chunk
+        :param columns: The names of the columns, in order
+        :param row_count: The number of rows filled in the arrays
+        :param string_columns: The columns not to convert to numbers
+        :return: A dataframe of the filled rows
+        """
+        df = pandas.DataFrame({column: chunk[column][:row_count] for column in columns}, columns=columns)
+        for column in columns:
+            if column not in string_columns:
+                df[column] = pandas.to_numeric(df[column], errors="ignore")
+        return df
+
+    @staticmethod
+    def _apply_result_schema(df, result_schema):
+        """
+        Converts an already parsed result dataframe to a result schema.
 
-        TODO: Maybe we don't need to return all of the payload... e.g. the request data could probably be dropped
-        TODO: and just response included in the final dataframe.
+        :param df: A result dataframe with all the response columns
+        :param result_schema: A dict of column name to dtype, or None to leave the dataframe as it is
+        :return: A dataframe with just the columns of the schema, in the given dtypes
         """
-        return pandas.read_csv(StringIO(response.content), header=1)
+        if result_schema is None:
+            return df
+        columns = [column for column in df.columns if column in result_schema]
+        return df[columns].astype({column: result_schema[column] for column in columns})
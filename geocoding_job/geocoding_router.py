@@ -0,0 +1,188 @@
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+import pandas
+import requests
+from .geocoding_job import GeocodingJob
+from .http_session import create_session
+from .multi_geocoding_job import MultiGeocodingJob
+
+
+class GeocodingRouter:
+    """
+    A front-end that picks the fastest way to geocode a batch. Creating and polling a Dataflow job takes tens of
+    seconds even for a handful of rows, so small batches, and batches with a deadline the Dataflow path cannot
+    meet, are geocoded with concurrent calls to the per-address Locations API over a pooled session instead. Large
+    batches go through MultiGeocodingJob. The results have the same columns either way.
+    """
+
+    BING_LOCATIONS_URL = "http://dev.virtualearth.net/REST/v1/Locations"
+
+    DEFAULT_ROW_THRESHOLD = 50
+    DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+    # A conservative estimate of how long the smallest Dataflow job takes from submission to results.
+    DEFAULT_DATAFLOW_LATENCY_SECONDS = 60.0
+    DEFAULT_REQUEST_TIMEOUT = (5, 10)
+
+    # The Locations API address fields and the CSV columns they map to.
+    _ADDRESS_FIELDS = [("addressLine", "AddressLine"), ("adminDistrict", "AdminDistrict"),
+                       ("adminDistrict2", "AdminDistrict2"), ("countryRegion", "CountryRegion"),
+                       ("formattedAddress", "FormattedAddress"), ("locality", "Locality"),
+                       ("postalCode", "PostalCode"), ("neighborhood", "Neighborhood"), ("landmark", "Landmark")]
+
+    def __init__(self, bing_key=None, row_threshold=DEFAULT_ROW_THRESHOLD,
+                 max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 dataflow_latency_seconds=DEFAULT_DATAFLOW_LATENCY_SECONDS, session=None,
+                 locations_url=BING_LOCATIONS_URL, request_timeout=DEFAULT_REQUEST_TIMEOUT, **job_kwargs):
+        """
+        :param bing_key: A valid Bing maps API key. Can be omitted in which case an environment variable named
+               BING_API_KEY is required.
+        :param row_threshold: Batches of at most this many rows are geocoded with the Locations API.
+        :param max_concurrent_requests: The maximum number of Locations API calls in flight at the same time.
+        :param dataflow_latency_seconds: Batches with a deadline shorter than this are geocoded with the Locations
+               API regardless of their size.
+        :param session: A requests.Session shared by all the requests. If omitted, a session with a connection pool
+               large enough for max_concurrent_requests is created.
+        :param locations_url: The url of the Locations API, e.g. to run against a local stand-in server.
+        :param request_timeout: The (connect, read) timeouts in seconds of a Locations API call.
+        :param job_kwargs: Other parameters of MultiGeocodingJob for the Dataflow path, e.g. cache or dataflow_url
+        """
+        self._bing_key = bing_key if bing_key is not None else os.environ["BING_API_KEY"]
+        self._row_threshold = row_threshold
+        self._max_concurrent_requests = max_concurrent_requests
+        self._dataflow_latency_seconds = dataflow_latency_seconds
+        self._session = session if session is not None else create_session(pool_size=max_concurrent_requests)
+        self._locations_url = locations_url
+        self._request_timeout = request_timeout
+        self._job_kwargs = job_kwargs
+
+    # Public interface
+    def geocode(self, data, result_schema=None, deadline_seconds=None):
+        """
+        Geocodes a batch with the Locations API or the Dataflow API, whichever is expected to be faster.
+
+        :param data: A pandas dataframe in the format accepted by GeocodingJob
+        :param result_schema: An optional dict of column name to dtype, see GeocodingJob.fetch_results
+        :param deadline_seconds: An optional time limit for the batch. On the Locations API path, the rows that
+               could not be geocoded in time are returned with the StatusCode 'Timeout'.
+        :return: A dataframe of the results, in the format of GeocodingJob.fetch_results
+        """
+        if self.uses_locations_api(len(data), deadline_seconds):
+            return self._geocode_addresses(data, result_schema, deadline_seconds)
+        return MultiGeocodingJob(data, bing_key=self._bing_key, session=self._session,
+                                 **self._job_kwargs).fetch_results(result_schema)
+
+    def uses_locations_api(self, row_count, deadline_seconds=None):
+        """
+        :param row_count: The number of rows in a batch
+        :param deadline_seconds: The optional time limit of the batch
+        :return: Whether the batch would be geocoded with the Locations API
+        """
+        return row_count <= self._row_threshold or \
+            (deadline_seconds is not None and deadline_seconds < self._dataflow_latency_seconds)
+
+    # Private methods
+    def _geocode_addresses(self, data, result_schema, deadline_seconds):
+        """
+        Geocodes every row with a Locations API call of its own, max_concurrent_requests at a time.
+
+        :return: A result dataframe
+        """
+        payload_df = GeocodingJob._build_payload_df(data)
+        deadline = time.time() + deadline_seconds if deadline_seconds is not None else None
+        rows = [row for _, row in payload_df.iterrows()]
+        if rows:
+            pool = ThreadPool(min(self._max_concurrent_requests, len(rows)))
+            try:
+                records = pool.map(lambda row: self._geocode_address(row, deadline), rows)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            records = []
+        df = pandas.DataFrame(records, columns=GeocodingJob.DEFAULT_PAYLOAD_HEADERS)
+        # Like the Dataflow output, the string columns of the schema are kept as strings, e.g. postal codes.
+        string_columns = GeocodingJob._string_dtypes(result_schema)
+        for column in df.columns:
+            if column not in string_columns:
+                df[column] = pandas.to_numeric(df[column], errors="ignore")
+        return GeocodingJob._apply_result_schema(df, result_schema)
+
+    def _geocode_address(self, row, deadline):
+        """
+        :param row: A row of a payload dataframe, see GeocodingJob._build_payload_df
+        :param deadline: The time by which the result is needed, or None
+        :return: A dict of the request and response columns of the row, as in the Dataflow CSV output
+        """
+        record = dict(row)
+        timeout = self._request_timeout
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                record.update({"StatusCode": "Timeout", "FaultReason": "The deadline passed before the request"})
+                return record
+            timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+        params = {"addressLine": row["GeocodeRequest/Address/AddressLine"],
+                  "locality": row["GeocodeRequest/Address/Locality"],
+                  "postalCode": row["GeocodeRequest/Address/PostalCode"],
+                  "countryRegion": row["GeocodeRequest/Address/CountryRegion"],
+                  "culture": row["GeocodeRequest/Culture"].replace("_", "-"), "maxResults": 1, "key": self._bing_key}
+        try:
+            response = self._session.get(self._locations_url, params=params, timeout=timeout)
+            response.raise_for_status()
+            body = json.loads(response.content)
+        except requests.exceptions.Timeout as e:
+            record.update({"StatusCode": "Timeout", "FaultReason": str(e)})
+            return record
+        except requests.exceptions.HTTPError as e:
+            record.update({"StatusCode": "BadRequest" if e.response.status_code < 500 else "ServerError",
+                           "FaultReason": str(e)})
+            return record
+        except (requests.exceptions.RequestException, ValueError) as e:
+            record.update({"StatusCode": "ServerError", "FaultReason": str(e)})
+            return record
+
+        record.update({"StatusCode": "Success", "TraceId": self._native_string(body.get("traceId"))})
+        resources = [resource for resource_set in body.get("resourceSets", [])
+                     for resource in resource_set.get("resources", [])]
+        if resources:
+            record.update({column: self._native_string(value)
+                           for column, value in self._response_columns(resources[0]).items()})
+        return record
+
+    @staticmethod
+    def _native_string(value):
+        """
+        :param value: A value decoded from the JSON response
+        :return: The value, with unicode strings encoded to UTF-8 str like the strings of the Dataflow output
+        """
+        if not isinstance(value, str) and hasattr(value, "encode"):
+            return value.encode("utf-8")
+        return value
+
+    @classmethod
+    def _response_columns(cls, resource):
+        """
+        :param resource: A location resource of the Locations API
+        :return: A dict of the corresponding GeocodeResponse columns of the Dataflow CSV output
+        """
+        address = resource.get("address", {})
+        columns = {"GeocodeResponse/Address/" + column: address.get(field) for field, column in cls._ADDRESS_FIELDS}
+        columns.update({"GeocodeResponse/Name": resource.get("name"),
+                        "GeocodeResponse/Confidence": resource.get("confidence"),
+                        "GeocodeResponse/EntityType": resource.get("entityType"),
+                        "GeocodeResponse/MatchCodes": ",".join(resource.get("matchCodes", []))})
+        coordinates = resource.get("point", {}).get("coordinates")
+        if coordinates:
+            columns["GeocodeResponse/Point/Latitude"], columns["GeocodeResponse/Point/Longitude"] = coordinates
+        bbox = resource.get("bbox")
+        if bbox:
+            (columns["GeocodeResponse/BoundingBox/SouthLatitude"], columns["GeocodeResponse/BoundingBox/WestLongitude"],
+             columns["GeocodeResponse/BoundingBox/NorthLatitude"],
+             columns["GeocodeResponse/BoundingBox/EastLongitude"]) = bbox
+        columns["GeocodeResponse/GeocodePoints"] = json.dumps([
+            {"Latitude": str(point["coordinates"][0]), "Longitude": str(point["coordinates"][1]),
+             "UsageTypes": ",".join(point.get("usageTypes", [])), "Type": point.get("type"),
+             "CalculationMethod": point.get("calculationMethod")} for point in resource.get("geocodePoints", [])])
+        return columns
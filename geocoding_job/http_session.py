@@ -0,0 +1,78 @@
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+
+# Request bodies larger than this many bytes are spooled to a temporary file rather than held in memory.
+DEFAULT_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+# The number of bytes read at a time when a spooled body is iterated.
+SPOOL_BLOCK_SIZE = 64 * 1024
+
+# Responses with these statuses are considered transient and retried.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR):
+    """
+    Creates a requests session with a pool of keep-alive connections and a retry policy, suitable for sharing
+    between many GeocodingJobs and threads.
+
+    Failed connection attempts are retried for all requests. Read errors and transient 5xx responses are only
+    retried for idempotent requests such as the status and download GETs; urllib3 never retries a POST, so a
+    job is not created twice.
+
+    :param pool_size: The maximum number of connections kept open per host
+    :param retries: The maximum number of retries per request
+    :param backoff_factor: The retries wait backoff_factor * 2 ** (retry number - 1) seconds
+    :return: A requests.Session
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS_CODES)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class SpooledBody:
+    """
+    A request body written from a stream of strings into memory, or into a temporary file once it grows past
+    max_size bytes. requests sends a generator body with chunked transfer encoding, a code path that ignores the
+    timeout of the request. A spooled body has a known length, so it is sent with a Content-Length header through
+    urllib3's urlopen, which applies the connect and read timeouts to the upload like to any other request.
+
+    The temporary file, if any, is removed when the body is closed or garbage collected.
+    """
+
+    def __init__(self, pieces, max_size=DEFAULT_SPOOL_MAX_SIZE):
+        """
+        :param pieces: A generator of strings, e.g. a request payload rendered piece by piece
+        :param max_size: The number of bytes held in memory before the body is moved to a temporary file
+        """
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        for piece in pieces:
+            self._file.write(piece)
+        self._length = self._file.tell()
+        self._file.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(lambda: self.read(SPOOL_BLOCK_SIZE), "")
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=0):
+        self._file.seek(offset, whence)
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+import time
+
+
+class Instrumentation:
+    """
+    The interface GeocodingJob reports its metrics through. This base class ignores everything; subclass it and
+    override the hooks to collect or export the metrics.
+
+    The phases timed are:
+     - payload_build: building the request payload dataframe from the input data
+     - upload: rendering and uploading the request payload, i.e. creating the Bing job
+     - poll: a single status check
+     - queue_wait: the time from creating the job until Bing reports it completed
+     - download: reading the output from the network
+     - parse: parsing the output into dataframes
+    The counters are rows_submitted, rows_succeeded and rows_failed.
+    """
+
+    PHASES = ["payload_build", "upload", "poll", "queue_wait", "download", "parse"]
+    COUNTERS = ["rows_submitted", "rows_succeeded", "rows_failed"]
+
+    def timing(self, job, phase, seconds, byte_count=None):
+        """
+        Called when a phase of a job has been completed.
+
+        :param job: The GeocodingJob
+        :param phase: One of PHASES
+        :param seconds: The duration of the phase
+        :param byte_count: The number of bytes transferred in the phase, for upload and download
+        """
+        pass
+
+    def count(self, job, counter, value):
+        """
+        Called when a counter of a job is incremented.
+
+        :param job: The GeocodingJob
+        :param counter: One of COUNTERS
+        :param value: The increment
+        """
+        pass
+
+
+class MetricsCollector(Instrumentation):
+    """
+    Aggregates the metrics of any number of jobs in memory and exports them in the Prometheus text format, e.g. for
+    the textfile collector of the node exporter. The collector can be shared by jobs running in several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.phase_counts = dict.fromkeys(self.PHASES, 0)
+        self.phase_bytes = dict.fromkeys(self.PHASES, 0)
+        self.last_phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def timing(self, job, phase, seconds, byte_count=None):
+        with self._lock:
+            self.phase_seconds[phase] += seconds
+            self.phase_counts[phase] += 1
+            self.phase_bytes[phase] += byte_count or 0
+            self.last_phase_seconds[phase] = seconds
+
+    def count(self, job, counter, value):
+        with self._lock:
+            self.counters[counter] += value
+
+    def prometheus_text(self):
+        """
+        :return: The metrics collected so far in the Prometheus text exposition format
+        """
+        with self._lock:
+            lines = ["# HELP geocoding_job_phase_seconds Time spent in each phase of the geocoding jobs.",
+                     "# TYPE geocoding_job_phase_seconds summary"]
+            for phase in self.PHASES:
+                lines.append('geocoding_job_phase_seconds_sum{{phase="{}"}} {}'.format(phase,
+                                                                                     self.phase_seconds[phase]))
+                lines.append('geocoding_job_phase_seconds_count{{phase="{}"}} {}'.format(phase,
+                                                                                       self.phase_counts[phase]))
+            lines += ["# HELP geocoding_job_last_phase_seconds Duration of the latest occurrence of each phase.",
+                      "# TYPE geocoding_job_last_phase_seconds gauge"]
+            lines += ['geocoding_job_last_phase_seconds{{phase="{}"}} {}'.format(phase, self.last_phase_seconds[phase])
+                      for phase in self.PHASES]
+            lines += ["# HELP geocoding_job_bytes_total Bytes transferred in each phase of the geocoding jobs.",
+                      "# TYPE geocoding_job_bytes_total counter"]
+            lines += ['geocoding_job_bytes_total{{phase="{}"}} {}'.format(phase, self.phase_bytes[phase])
+                      for phase in ["upload", "download"]]
+            lines += ["# HELP geocoding_job_rows_total Rows submitted to and geocoded by Bing.",
+                      "# TYPE geocoding_job_rows_total counter"]
+            lines += ['geocoding_job_rows_total{{outcome="{}"}} {}'.format(counter[len("rows_"):],
+                                                                           self.counters[counter])
+                      for counter in self.COUNTERS]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics to a file in the Prometheus text format. The file is replaced atomically so that a
+        scraper never reads a partially written file.
+
+        :param path: The path of the file to write
+        """
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus_text())
+        os.rename(temporary_path, path)
+
+
+class JsonLinesExporter(Instrumentation):
+    """
+    Writes every metric event as a line of structured JSON, e.g. for shipping to a log based metrics pipeline.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the file the events are appended to
+        """
+        self._path = path
+        self._lock = threading.Lock()
+
+    def timing(self, job, phase, seconds, byte_count=None):
+        self._write({'event': 'timing', 'job_name': job.job_name, 'phase': phase, 'seconds': seconds,
+                     'bytes': byte_count})
+
+    def count(self, job, counter, value):
+        self._write({'event': 'count', 'job_name': job.job_name, 'counter': counter, 'value': value})
+
+    def _write(self, event):
+        event['time'] = time.time()
+        with self._lock:
+            with open(self._path, 'a') as events_file:
+                events_file.write(json.dumps(event) + "\n")
+
+
+class MeteredStream:
+    """
+    Wraps a file-like object, such as a streamed response body, and measures the bytes read from it and the time
+    spent waiting for them.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.byte_count = 0
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        started = time.time()
+        data = self._stream.read(size) if size is not None and size >= 0 else self._stream.read()
+        self.seconds += time.time() - started
+        self.byte_count += len(data)
+        return data
+
+    def readline(self):
+        started = time.time()
+        line = self._stream.readline()
+        self.seconds += time.time() - started
+        self.byte_count += len(line)
+        return line
+
+    def __iter__(self):
+        # pandas only accepts iterable file-like objects.
+        return iter(self.readline, b"")
@@ -0,0 +1,127 @@
+import heapq
+import itertools
+import time
+from collections import deque
+import requests
+from .geocoding_job import GeocodingJob
+
+
+class JobCoordinator:
+    """
+    Waits for any number of submitted GeocodingJobs in a single thread. Instead of blocking in each job's poll loop,
+    the coordinator acts as a shared scheduler: every job is due for its next status check at the time decided by
+    its polling policy, and the coordinator sleeps until the earliest due time. All the jobs that fall due within
+    a short batching window are then checked in one round, and the results of each job are handed out as soon as
+    Bing has completed it.
+    """
+
+    DEFAULT_BATCH_WINDOW_SECONDS = 1.0
+    DEFAULT_MAX_REQUEST_ERRORS = 5
+
+    def __init__(self, batch_window_seconds=DEFAULT_BATCH_WINDOW_SECONDS,
+                 max_request_errors=DEFAULT_MAX_REQUEST_ERRORS):
+        """
+        :param batch_window_seconds: Jobs that fall due at most this many seconds after the earliest due job are
+               checked in the same round.
+        :param max_request_errors: The number of consecutive network errors after which a job is given up on.
+        """
+        self._batch_window_seconds = batch_window_seconds
+        self._max_request_errors = max_request_errors
+        # The number of consecutive network errors of each job that has had any.
+        self._request_errors = {}
+        # A heap of (due time, sequence number, job) tuples. The sequence number keeps the order stable.
+        self._schedule = []
+        self._sequence = itertools.count()
+        self.failed = []
+
+    # Public interface
+    def add(self, job):
+        """
+        Adds a job to be waited for. Jobs that have not been submitted yet are submitted right away.
+
+        :param job: A GeocodingJob
+        :return: The JobHandle of the job
+        """
+        if job.status == GeocodingJob.GCStatus.initialized:
+            job.submit()
+        self._schedule_job(job, time.time())
+        return job.handle
+
+    def as_completed(self):
+        """
+        Polls the jobs in flight until all of them are done. Jobs can be added while iterating. Jobs that fail are
+        not yielded but collected in self.failed instead. The follow-up job a job resubmits its transiently failed
+        rows in (see GeocodingJob.collect_chunks) is polled along with the others and yielded once it completes.
+
+        A network error only affects the job whose request failed: the job is checked again after its next poll
+        interval, and moved to self.failed after max_request_errors consecutive errors.
+
+        :return: A generator of (job, result dataframe) tuples in the order the jobs complete
+        """
+        while self._schedule:
+            time.sleep(max(0, self._schedule[0][0] - time.time()))
+            batch_due = self._schedule[0][0] + self._batch_window_seconds
+            pending = deque()
+            while self._schedule and self._schedule[0][0] <= batch_due:
+                pending.append(heapq.heappop(self._schedule)[2])
+
+            try:
+                while pending:
+                    job = pending[0]
+                    df = self._check_job(job)
+                    pending.popleft()
+                    if df is not None:
+                        yield job, df
+            finally:
+                # If an unexpected error escapes or the iteration is stopped, the jobs of the round not handled yet
+                # are put back, so that they are not lost if as_completed is called again.
+                for job in pending:
+                    self._schedule_job(job, time.time())
+
+    def __len__(self):
+        return len(self._schedule)
+
+    # Private methods
+    def _check_job(self, job):
+        """
+        Polls a job once and collects its results if Bing has completed it. A job that is not done yet is scheduled
+        again, and so is a job whose request failed with a network error, unless it has failed too many times.
+
+        :param job: A GeocodingJob
+        :return: The result dataframe of the job, or None if the job is not done or has failed
+        """
+        try:
+            if not job.poll():
+                self._request_errors.pop(job, None)
+                self._schedule_job(job, time.time() + job.next_poll_interval())
+                return None
+            df = job.collect()
+        except GeocodingJob.GeocodingException:
+            self._fail_job(job)
+            return None
+        except requests.exceptions.RequestException:
+            self._request_errors[job] = self._request_errors.get(job, 0) + 1
+            if self._request_errors[job] >= self._max_request_errors:
+                self._fail_job(job)
+            else:
+                self._schedule_job(job, time.time() + job.next_poll_interval())
+            return None
+        self._request_errors.pop(job, None)
+        if job.retry_job is not None:
+            self._schedule_job(job.retry_job, time.time() + job.retry_job.next_poll_interval())
+        return df
+
+    def _fail_job(self, job):
+        """
+        :param job: A GeocodingJob given up on
+        """
+        self._request_errors.pop(job, None)
+        job._set_status(GeocodingJob.GCStatus.error)
+        self.failed.append(job)
+
+    def _schedule_job(self, job, due):
+        """
+        :param job: A GeocodingJob
+        :param due: The time (as returned by time.time) of the next status check of the job
+        """
+        heapq.heappush(self._schedule, (due, next(self._sequence), job))
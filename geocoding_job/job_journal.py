@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+import time
+
+
+class JobJournal:
+    """
+    A small append-only journal of GeocodingJob state transitions, stored locally as a file of JSON lines. Every
+    entry records the status of a named job together with the Bing job id, status url and output links known at
+    that point, so that a job can be picked up with GeocodingJob.resume after the process has been restarted.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the journal file. Created if it does not exist.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+
+    # Public interface
+    def record(self, job_name, status, job_id=None, status_url=None, output_links=None, duplicate_rows=0,
+               cached_rows=0):
+        """
+        Appends an entry to the journal. The entry is flushed to disk before returning.
+
+        :param job_name: The name identifying the GeocodingJob
+        :param status: The new GeocodingJob.GCStatus of the job
+        :param job_id: The Bing job id, if known
+        :param status_url: The url the status of the Bing job can be read from, if known
+        :param output_links: A dict of output name (e.g. 'succeeded') to url, if known
+        :param duplicate_rows: The number of input rows the job left out as duplicates of other rows
+        :param cached_rows: The number of input rows the job answered from a cache rather than sent to Bing
+        """
+        # Depending on which enum package is installed, GCStatus members are either Enum members or plain strings.
+        entry = json.dumps({'job_name': job_name, 'status': getattr(status, 'value', status), 'job_id': job_id,
+                            'status_url': status_url, 'output_links': output_links or {},
+                            'duplicate_rows': duplicate_rows, 'cached_rows': cached_rows, 'time': time.time()})
+        with self._lock:
+            with open(self._path, 'a') as journal_file:
+                journal_file.write(entry + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def last_entry(self, job_name):
+        """
+        :param job_name: The name identifying the GeocodingJob
+        :return: The most recent entry of the job as a dict, or None if the job is not in the journal
+        """
+        return self._last_entries().get(job_name)
+
+    def unfinished_job_names(self):
+        """
+        :return: The names of the jobs whose most recent status is not 'completed'
+        """
+        return [job_name for job_name, entry in self._last_entries().items() if entry['status'] != 'completed']
+
+    # Private methods
+    def _last_entries(self):
+        """
+        :return: A dict of job name to the most recent entry of the job
+        """
+        entries = {}
+        if not os.path.exists(self._path):
+            return entries
+        with self._lock:
+            with open(self._path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line only partially written when the process died.
+                        continue
+                    entries[entry['job_name']] = entry
+        return entries
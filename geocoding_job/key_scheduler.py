@@ -0,0 +1,234 @@
+import errno
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from .geocoding_job import GeocodingJob
+
+
+class KeyScheduler:
+    """
+    Hands out Bing API keys from a pool so that the Dataflow limits of every key are respected. Each key has a
+    budget of concurrently running jobs and a token bucket of transactions, one transaction per submitted entity,
+    which is refilled continuously at the rate of the daily quota. A job leases a key for its duration; when no key
+    has room for it, the job waits in line until one does. Among the keys with room, the least busy one is chosen,
+    so the work is spread across the keys.
+
+    The budgets are kept in a local SQLite database, so all the threads and processes of a host that use the same
+    database file share them. Every lease records the host and the process that holds it, and the leases of
+    processes of this host that no longer exist, e.g. because they were killed, are reclaimed at once.
+    """
+
+    Lease = namedtuple("Lease", ["lease_id", "bing_key", "entity_count"])
+
+    DEFAULT_MAX_CONCURRENT_JOBS_PER_KEY = 10
+    DEFAULT_WAIT_INTERVAL_SECONDS = 1.0
+    # A lease not released in this time no longer counts as a running job. This only matters for the leases of
+    # other hosts, whose processes cannot be checked, as those of dead processes of this host are reclaimed anyway.
+    DEFAULT_LEASE_TTL_SECONDS = 24 * 60 * 60
+
+    _SECONDS_PER_DAY = 24 * 60 * 60
+
+    def __init__(self, bing_keys, path, max_concurrent_jobs_per_key=DEFAULT_MAX_CONCURRENT_JOBS_PER_KEY,
+                 transactions_per_day=None, wait_interval_seconds=DEFAULT_WAIT_INTERVAL_SECONDS,
+                 lease_ttl_seconds=DEFAULT_LEASE_TTL_SECONDS):
+        """
+        :param bing_keys: A list of valid Bing spatial data API keys
+        :param path: Path of the SQLite database file the budgets are kept in. Created if it does not exist.
+        :param max_concurrent_jobs_per_key: The maximum number of jobs running at the same time with one key.
+        :param transactions_per_day: The transaction quota of every key, or None for no quota. Up to a full day's
+               quota can be used in a burst.
+        :param wait_interval_seconds: How often a waiting job checks the budgets again.
+        :param lease_ttl_seconds: How long a lease of another host that is never released counts as a running job.
+        """
+        if not bing_keys:
+            raise GeocodingJob.GeocodingException("At least one Bing API key is needed")
+        if max_concurrent_jobs_per_key < 1:
+            raise GeocodingJob.GeocodingException("At least one concurrent job per key is needed")
+        self._bing_keys = list(bing_keys)
+        self._path = path
+        self._max_concurrent_jobs_per_key = max_concurrent_jobs_per_key
+        self._transactions_per_day = transactions_per_day
+        self._wait_interval_seconds = wait_interval_seconds
+        self._lease_ttl_seconds = lease_ttl_seconds
+        with self._transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (bing_key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                               "updated REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS leases (lease_id TEXT PRIMARY KEY, "
+                               "bing_key TEXT NOT NULL, acquired REAL NOT NULL, hostname TEXT, pid INTEGER)")
+            # Databases created before the leases recorded their owners are upgraded in place.
+            lease_columns = [row[1] for row in connection.execute("PRAGMA table_info(leases)")]
+            for column, column_type in [("hostname", "TEXT"), ("pid", "INTEGER")]:
+                if column not in lease_columns:
+                    connection.execute("ALTER TABLE leases ADD COLUMN {} {}".format(column, column_type))
+            # Without a quota the buckets are left alone, so a process with a quota sharing the database later
+            # starts from full buckets.
+            if transactions_per_day is not None:
+                for bing_key in self._bing_keys:
+                    connection.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)",
+                                       (bing_key, transactions_per_day, time.time()))
+
+    # Public interface
+    def try_acquire(self, entity_count):
+        """
+        Leases a key for a job if one has room for it right now.
+
+        :param entity_count: The number of entities the job submits
+        :return: A KeyScheduler.Lease, or None if every key is busy or out of transactions
+        """
+        if self._transactions_per_day is not None and entity_count > self._transactions_per_day:
+            raise GeocodingJob.GeocodingException("A job of {} entities exceeds the daily quota of {} transactions"
+                                                  .format(entity_count, self._transactions_per_day))
+        now = time.time()
+        with self._transaction() as connection:
+            running = self._count_running(connection, now)
+            tokens = {bing_key: self._refilled_tokens(bucket_tokens, updated, now) for bing_key, bucket_tokens, updated
+                      in connection.execute("SELECT bing_key, tokens, updated FROM buckets")}
+            candidates = [bing_key for bing_key in self._bing_keys
+                          if running.get(bing_key, 0) < self._max_concurrent_jobs_per_key and
+                          (self._transactions_per_day is None or tokens[bing_key] >= entity_count)]
+            if not candidates:
+                return None
+            bing_key = min(candidates, key=lambda candidate: (running.get(candidate, 0), -tokens.get(candidate, 0)))
+            lease = self.Lease(uuid.uuid4().hex, bing_key, entity_count)
+            if self._transactions_per_day is not None:
+                connection.execute("UPDATE buckets SET tokens = ?, updated = ? WHERE bing_key = ?",
+                                   (tokens[bing_key] - entity_count, now, bing_key))
+            connection.execute("INSERT INTO leases (lease_id, bing_key, acquired, hostname, pid) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               (lease.lease_id, bing_key, now, socket.gethostname(), os.getpid()))
+        return lease
+
+    def acquire(self, entity_count, timeout_seconds=None):
+        """
+        Leases a key for a job, waiting until one has room for it.
+
+        :param entity_count: The number of entities the job submits
+        :param timeout_seconds: The longest time to wait, or None to wait for as long as it takes
+        :return: A KeyScheduler.Lease
+        """
+        started = time.time()
+        while True:
+            lease = self.try_acquire(entity_count)
+            if lease is not None:
+                return lease
+            if timeout_seconds is not None and time.time() - started >= timeout_seconds:
+                raise GeocodingJob.GeocodingException("No Bing API key became available in {} seconds".format(
+                    timeout_seconds))
+            time.sleep(self._wait_interval_seconds)
+
+    def release(self, lease):
+        """
+        Ends a lease once its job has finished. The transactions of the job stay spent.
+
+        :param lease: A KeyScheduler.Lease returned by acquire
+        """
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM leases WHERE lease_id = ?", (lease.lease_id,))
+
+    def charge(self, bing_key, entity_count):
+        """
+        Spends transactions of a key outside of acquire, e.g. for the follow-up jobs a leased job resubmits its
+        failed rows in. The bucket can go below zero, in which case the key gets no new jobs until it has been
+        refilled.
+
+        :param bing_key: One of the keys of the scheduler
+        :param entity_count: The number of entities submitted
+        """
+        if self._transactions_per_day is None or not entity_count:
+            return
+        now = time.time()
+        with self._transaction() as connection:
+            tokens, updated = connection.execute("SELECT tokens, updated FROM buckets WHERE bing_key = ?",
+                                                 (bing_key,)).fetchone()
+            connection.execute("UPDATE buckets SET tokens = ?, updated = ? WHERE bing_key = ?",
+                               (self._refilled_tokens(tokens, updated, now) - entity_count, now, bing_key))
+
+    @contextmanager
+    def lease(self, entity_count, timeout_seconds=None):
+        """
+        Leases a key for the duration of the block, see acquire.
+
+        :param entity_count: The number of entities the job submits
+        :param timeout_seconds: The longest time to wait, or None to wait for as long as it takes
+        :return: A context manager yielding the Bing API key to use
+        """
+        lease = self.acquire(entity_count, timeout_seconds)
+        try:
+            yield lease.bing_key
+        finally:
+            self.release(lease)
+
+    def running_jobs(self):
+        """
+        :return: A dict of every key to the number of jobs currently running with it
+        """
+        with self._transaction() as connection:
+            running = self._count_running(connection, time.time())
+        return {bing_key: running.get(bing_key, 0) for bing_key in self._bing_keys}
+
+    # Private methods
+    def _count_running(self, connection, now):
+        """
+        Reclaims the leases of the dead processes of this host, and counts the leases left.
+
+        :param connection: A connection in a transaction, see _transaction
+        :param now: The current time
+        :return: A dict of the keys with running jobs to the number of their jobs
+        """
+        hostname = socket.gethostname()
+        dead_leases = [(lease_id,) for lease_id, pid in connection.execute(
+            "SELECT lease_id, pid FROM leases WHERE hostname = ?", (hostname,)) if not self._process_exists(pid)]
+        connection.executemany("DELETE FROM leases WHERE lease_id = ?", dead_leases)
+        return dict(connection.execute("SELECT bing_key, COUNT(*) FROM leases WHERE acquired >= ? GROUP BY bing_key",
+                                       (now - self._lease_ttl_seconds,)))
+
+    @staticmethod
+    def _process_exists(pid):
+        """
+        :param pid: The id of a process of this host
+        :return: Whether the process is still running
+        """
+        if os.name == "nt":
+            # os.kill would terminate the process on Windows, so the leases are left to expire there.
+            return True
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _refilled_tokens(self, tokens, updated, now):
+        """
+        :param tokens: The tokens in the bucket of a key when it was last updated
+        :param updated: The time of the last update
+        :param now: The current time
+        :return: The tokens in the bucket now, capped at the daily quota
+        """
+        if self._transactions_per_day is None:
+            return tokens
+        refill = (now - updated) * self._transactions_per_day / float(self._SECONDS_PER_DAY)
+        return min(float(self._transactions_per_day), tokens + refill)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Opens a new connection and an immediate transaction, which holds the write lock of the database from the
+        start so that the budgets are read and updated atomically even across processes. The transaction is
+        committed and the connection closed when the block exits.
+        """
+        connection = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        connection.text_factory = str
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
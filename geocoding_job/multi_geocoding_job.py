@@ -0,0 +1,150 @@
+import functools
+import os
+import pandas
+from multiprocessing.pool import ThreadPool
+from .geocoding_job import GeocodingJob
+from .http_session import create_session
+
+
+def validate_chunking(chunk_size, max_concurrent_jobs):
+    """
+    :param chunk_size: The maximum number of rows submitted in one Bing job
+    :param max_concurrent_jobs: The maximum number of Bing jobs in flight at the same time
+    :raise GeocodingJob.GeocodingException: If either is out of range
+    """
+    if not 0 < chunk_size <= GeocodingJob.MAX_ENTITIES_PER_JOB:
+        raise GeocodingJob.GeocodingException("The chunk size must be between 1 and {}".format(
+            GeocodingJob.MAX_ENTITIES_PER_JOB))
+    if max_concurrent_jobs < 1:
+        raise GeocodingJob.GeocodingException("At least one concurrent job is needed")
+
+
+def fetch_chunk_results(job_factory, chunk, result_schema=None, bing_key=None, key_scheduler=None,
+                        key_wait_timeout_seconds=None):
+    """
+    Geocodes a chunk as a single job and blocks until its results are available. With a key_scheduler, the job
+    waits for a key with room for the chunk and runs with that key instead of bing_key.
+
+    :param job_factory: A callable creating the job of a chunk, given the chunk and a bing_key keyword argument
+    :param chunk: A pandas dataframe of at most GeocodingJob.MAX_ENTITIES_PER_JOB rows
+    :param result_schema: An optional dict of column name to dtype, see GeocodingJob.fetch_results
+    :param bing_key: The Bing API key to run the job with if there is no key_scheduler
+    :param key_scheduler: An optional key_scheduler.KeyScheduler to lease the key from
+    :param key_wait_timeout_seconds: The longest time to wait for a key, or None to wait for as long as it takes
+    :return: The result dataframe of the chunk
+    """
+    if key_scheduler is None:
+        return job_factory(chunk, bing_key=bing_key).fetch_results(result_schema)
+    with key_scheduler.lease(len(chunk), key_wait_timeout_seconds) as leased_key:
+        job = job_factory(chunk, bing_key=leased_key)
+        try:
+            return job.fetch_results(result_schema)
+        finally:
+            # The follow-up jobs of the rows failed by transient faults run with the leased key too.
+            key_scheduler.charge(leased_key, job.resubmitted_row_count())
+
+
+class MultiGeocodingJob:
+    """
+    Geocodes input data that is too large for a single Bing Dataflow job. The input is split into chunks that
+    fit the service limits and each chunk is run as a GeocodingJob of its own. The jobs are submitted and waited
+    for side by side by a bounded pool of worker threads, so the total wall-clock time is set by the slowest
+    chunk rather than the sum of all of them.
+    """
+
+    DEFAULT_MAX_CONCURRENT_JOBS = 4
+
+    def __init__(self, data, bing_key=None, chunk_size=GeocodingJob.MAX_ENTITIES_PER_JOB,
+                 max_concurrent_jobs=DEFAULT_MAX_CONCURRENT_JOBS, cache=None,
+                 polling_policy=None, deduplicate=False, session=None,
+                 dataflow_url=GeocodingJob.BING_DATAFLOW_URL, instrumentation=None,
+                 failed_row_retries=GeocodingJob.DEFAULT_FAILED_ROW_RETRIES, compress_upload=False,
+                 key_scheduler=None, input_format="csv", key_wait_timeout_seconds=None):
+        """
+        :param data: A pandas dataframe in the format accepted by GeocodingJob, of any length.
+        :param bing_key: A valid Bing spatial data API key. Can be omitted in which case an environment variable
+               named BING_API_KEY is required, unless a key_scheduler is given.
+        :param chunk_size: The maximum number of rows submitted in one Bing job. Cannot exceed
+               GeocodingJob.MAX_ENTITIES_PER_JOB.
+        :param max_concurrent_jobs: The maximum number of Bing jobs in flight at the same time.
+        :param cache: An optional result_cache.ResultCache shared by the jobs of all the chunks.
+        :param polling_policy: An optional polling_policy.PollingPolicy used by the jobs of all the chunks.
+        :param deduplicate: Whether to send identical addresses within a chunk to Bing only once, see GeocodingJob.
+        :param session: A requests.Session shared by the jobs of all the chunks. If omitted, a session with a
+               connection pool large enough for max_concurrent_jobs is created.
+        :param dataflow_url: The url of the geocode dataflow service, see GeocodingJob.
+        :param instrumentation: An optional instrumentation.Instrumentation shared by the jobs of all the chunks.
+        :param failed_row_retries: How many times rows failed by a transient fault are resubmitted, see GeocodingJob.
+        :param compress_upload: Whether to gzip the request payloads as they are uploaded, see GeocodingJob.
+        :param key_scheduler: An optional key_scheduler.KeyScheduler. If given, every chunk waits for a key with
+               room for it and is run with that key instead of bing_key.
+        :param input_format: The payload format of the jobs, 'csv' or 'xml', see GeocodingJob.
+        :param key_wait_timeout_seconds: The longest time a chunk waits for a key of the key_scheduler, or None to
+               wait for as long as it takes.
+        """
+        validate_chunking(chunk_size, max_concurrent_jobs)
+        self._bing_key = bing_key if bing_key is not None or key_scheduler is not None else os.environ["BING_API_KEY"]
+        self._key_scheduler = key_scheduler
+        self._chunks = [data.iloc[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+        self._max_concurrent_jobs = max_concurrent_jobs
+        self._cache = cache
+        self._polling_policy = polling_policy
+        self._deduplicate = deduplicate
+        self._session = session if session is not None else create_session(pool_size=max_concurrent_jobs)
+        self._dataflow_url = dataflow_url
+        self._instrumentation = instrumentation
+        self._failed_row_retries = failed_row_retries
+        self._compress_upload = compress_upload
+        self._input_format = input_format
+        self._key_wait_timeout_seconds = key_wait_timeout_seconds
+        self.jobs = []
+
+    # Public interface
+    def fetch_results(self, result_schema=None):
+        """
+        Runs all the chunks through Bing and joins the results.
+
+        :param result_schema: An optional dict of column name to dtype, see GeocodingJob.fetch_results
+        :return: A dataframe containing the results of all the chunks, in the order of the input chunks
+        """
+        if not self._chunks:
+            return pandas.DataFrame(columns=GeocodingJob.BING_CSV_HEADERS)
+        self.jobs = [None] * len(self._chunks)
+        pool = ThreadPool(min(self._max_concurrent_jobs, len(self._chunks)))
+        try:
+            # The jobs are only created in the worker threads so that the request payloads of all the chunks
+            # need not be held in memory at the same time.
+            frames = pool.map(lambda index: self._fetch_chunk(index, result_schema), range(len(self._chunks)))
+        finally:
+            pool.close()
+            pool.join()
+        df = pandas.concat(frames, ignore_index=True)
+        # Categoricals with different categories are concatenated as objects, so the dtypes are restored here.
+        return GeocodingJob._apply_result_schema(df, result_schema)
+
+    # Private methods
+    def _fetch_chunk(self, index, result_schema):
+        """
+        Creates the GeocodingJob for a single chunk and blocks until its results are available.
+
+        :param index: The index of the chunk in self._chunks
+        :param result_schema: An optional dict of column name to dtype
+        :return: The result dataframe of the chunk
+        """
+        return fetch_chunk_results(functools.partial(self._create_job, index), self._chunks[index], result_schema,
+                                   self._bing_key, self._key_scheduler, self._key_wait_timeout_seconds)
+
+    def _create_job(self, index, chunk, bing_key):
+        """
+        :param index: The index of the chunk in self._chunks
+        :param chunk: The chunk
+        :param bing_key: The Bing API key to run the job with
+        :return: The GeocodingJob of the chunk, also stored in self.jobs
+        """
+        job = GeocodingJob(chunk, bing_key=bing_key, cache=self._cache,
+                           polling_policy=self._polling_policy, deduplicate=self._deduplicate, session=self._session,
+                           dataflow_url=self._dataflow_url, instrumentation=self._instrumentation,
+                           failed_row_retries=self._failed_row_retries, compress_upload=self._compress_upload,
+                           input_format=self._input_format)
+        self.jobs[index] = job
+        return job
@@ -0,0 +1,91 @@
+import math
+import random
+
+
+class PollingPolicy:
+    """
+    Decides how long to wait before the next status check of a Bing job. The first checks are made after short
+    intervals that grow exponentially up to an upper bound. Larger jobs start from longer intervals, and when Bing
+    reports how many entities it has processed so far, the next check is timed for when the job is expected to
+    complete. Some random jitter is added so that many jobs started at once do not poll in lockstep.
+    """
+
+    DEFAULT_INITIAL_INTERVAL_SECONDS = 1.0
+    DEFAULT_BACKOFF_FACTOR = 2.0
+    DEFAULT_MAX_INTERVAL_SECONDS = 60.0
+    DEFAULT_JITTER = 0.1
+
+    # A rough estimate of how long Bing takes per entity, used to scale the intervals by the job size before any
+    # progress information is available.
+    DEFAULT_SECONDS_PER_ENTITY = 0.002
+
+    def __init__(self, initial_interval_seconds=DEFAULT_INITIAL_INTERVAL_SECONDS,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, max_interval_seconds=DEFAULT_MAX_INTERVAL_SECONDS,
+                 jitter=DEFAULT_JITTER, seconds_per_entity=DEFAULT_SECONDS_PER_ENTITY):
+        """
+        :param initial_interval_seconds: The wait before the first status check of a small job.
+        :param backoff_factor: How much the interval grows after each unsuccessful status check.
+        :param max_interval_seconds: The upper bound of the interval.
+        :param jitter: The relative amount of random variation added to the interval, e.g. 0.1 for +-10 %.
+        :param seconds_per_entity: The estimated processing time per entity, used to scale the intervals by the
+               job size.
+        """
+        self._initial_interval_seconds = initial_interval_seconds
+        self._backoff_factor = backoff_factor
+        self._max_interval_seconds = max_interval_seconds
+        self._jitter = jitter
+        self._seconds_per_entity = seconds_per_entity
+
+    # Public interface
+    def interval(self, attempt, entity_count=0, resource=None, elapsed_seconds=None):
+        """
+        :param attempt: The number of status checks made so far
+        :param entity_count: The number of entities submitted in the job
+        :param resource: The latest Bing resource JSON of the job, if any
+        :param elapsed_seconds: The time since the job was submitted
+        :return: The number of seconds to wait before the next status check
+        """
+        interval = self._backoff_interval(attempt)
+        # Do not check a large job more often than a few times during its expected processing time.
+        interval = max(interval, entity_count * self._seconds_per_entity / 4)
+
+        remaining = self._estimate_remaining_seconds(resource, elapsed_seconds)
+        if remaining is not None:
+            interval = max(min(interval, remaining), self._initial_interval_seconds)
+
+        # The jitter is applied before the upper bound so that the bound is never exceeded.
+        interval *= random.uniform(1 - self._jitter, 1 + self._jitter)
+        return min(interval, self._max_interval_seconds)
+
+    # Private methods
+    def _backoff_interval(self, attempt):
+        """
+        :param attempt: The number of status checks made so far
+        :return: The exponentially grown interval, at most the upper bound
+        """
+        if self._initial_interval_seconds <= 0:
+            return self._initial_interval_seconds
+        if self._backoff_factor > 1:
+            # The interval reaches the upper bound after this many attempts. Raising the factor to higher powers
+            # would only risk an OverflowError for jobs that have been polled for long enough.
+            attempts_to_bound = math.log(max(self._max_interval_seconds, self._initial_interval_seconds) /
+                                         self._initial_interval_seconds, self._backoff_factor)
+            attempt = min(attempt, int(math.ceil(attempts_to_bound)))
+        return min(self._initial_interval_seconds * self._backoff_factor ** attempt, self._max_interval_seconds)
+
+    @staticmethod
+    def _estimate_remaining_seconds(resource, elapsed_seconds):
+        """
+        Estimates the time left until Bing completes the job from the progress fields of the resource JSON.
+
+        :param resource: A Bing resource JSON
+        :param elapsed_seconds: The time since the job was submitted
+        :return: The estimated remaining seconds or None if the resource does not tell enough about the progress
+        """
+        if resource is None or not elapsed_seconds:
+            return None
+        processed = resource.get('processedEntityCount')
+        total = resource.get('totalEntityCount')
+        if not processed or not total:
+            return None
+        return (total - processed) * elapsed_seconds / float(processed)
@@ -0,0 +1,128 @@
+import pickle
+import sqlite3
+import time
+import pandas
+from contextlib import contextmanager
+from .geocoding_job import GeocodingJob
+
+
+class ResultCache:
+    """
+    A persistent, address level cache of Bing geocoding results stored in a local SQLite database. Results are
+    keyed on the normalized address fields of the Bing request payload, so an address that has been geocoded
+    once is answered from the cache on subsequent runs instead of being sent to Bing again.
+
+    The result rows are stored pickled, so that the values come back with the types they were stored with, e.g. as
+    UTF-8 encoded str rather than unicode under Python 2.
+    """
+
+    # The payload columns that identify an address. See GeocodingJob._build_payload_df.
+    KEY_COLUMNS = ["GeocodeRequest/Address/AddressLine", "GeocodeRequest/Address/Locality",
+                   "GeocodeRequest/Address/PostalCode", "GeocodeRequest/Address/CountryRegion",
+                   "GeocodeRequest/Culture"]
+
+    DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+    DEFAULT_MAX_ENTRIES = 1000000
+
+    # SQLite limits the number of host parameters in a single statement, so lookups are done in batches.
+    _LOOKUP_BATCH_SIZE = 500
+    _KEY_SEPARATOR = "\x1f"
+
+    def __init__(self, path, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param path: Path of the SQLite database file. Created if it does not exist.
+        :param ttl_seconds: How long a cached result is considered valid.
+        :param max_entries: The maximum number of results kept. The oldest ones are evicted first.
+        """
+        self._path = path
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS results (address_key TEXT PRIMARY KEY, " +
+                               "result BLOB NOT NULL, created REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+
+    # Public interface
+    def lookup(self, payload_df):
+        """
+        Splits a Bing request payload dataframe into the rows that can be answered from the cache and the rows
+        that still need to be geocoded.
+
+        :param payload_df: A dataframe as returned by GeocodingJob._build_payload_df
+        :return: A tuple (hits, misses) where hits is a result dataframe for the cached rows, with the Id of the
+                 requesting rows, and misses contains the payload rows not found in the cache
+        """
+        keys = self._address_keys(payload_df)
+        cached = {}
+        unique_keys = list(keys.unique())
+        with self._connect() as connection:
+            for start in range(0, len(unique_keys), self._LOOKUP_BATCH_SIZE):
+                batch = unique_keys[start:start + self._LOOKUP_BATCH_SIZE]
+                rows = connection.execute(
+                    # Entries in the JSON format of earlier versions are treated as misses and replaced on store.
+                    "SELECT address_key, result FROM results WHERE created >= ? AND typeof(result) = 'blob' " +
+                    "AND address_key IN ({})".format(",".join("?" * len(batch))),
+                    [time.time() - self._ttl_seconds] + batch)
+                cached.update(rows)
+
+        is_hit = keys.isin(list(cached))
+        records = []
+        for request_id, key in zip(payload_df["Id"][is_hit], keys[is_hit]):
+            record = pickle.loads(bytes(cached[key]))
+            record["Id"] = request_id
+            records.append(record)
+        hits = pandas.DataFrame(records)
+        hits = hits[[column for column in GeocodingJob.BING_CSV_HEADERS if column in hits.columns]]
+        return hits, payload_df[~is_hit]
+
+    def store(self, payload_df, results):
+        """
+        Stores the successfully geocoded results in the cache and evicts expired and excess entries.
+
+        :param payload_df: The request payload dataframe the results were obtained for
+        :param results: A result dataframe as returned by GeocodingJob.fetch_results
+        """
+        if "StatusCode" in results.columns:
+            results = results[results["StatusCode"] == "Success"]
+        keys = pandas.Series(self._address_keys(payload_df).values, index=payload_df["Id"].values)
+        keys = keys[~keys.index.duplicated()]
+        results = results[results["Id"].isin(keys.index)]
+        now = time.time()
+        entries = [(keys[record.pop("Id")], sqlite3.Binary(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)), now)
+                   for record in results.to_dict(orient="records")]
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO results (address_key, result, created) VALUES (?, ?, ?)",
+                                   entries)
+            connection.execute("DELETE FROM results WHERE created < ?", [now - self._ttl_seconds])
+            connection.execute("DELETE FROM results WHERE address_key IN (SELECT address_key FROM results " +
+                               "ORDER BY created DESC LIMIT -1 OFFSET ?)", [self._max_entries])
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    # Private methods
+    @contextmanager
+    def _connect(self):
+        """
+        A new connection is opened for every operation so that the same cache can be used from several threads
+        and processes. The transaction is committed and the connection closed when the block exits.
+        """
+        connection = sqlite3.connect(self._path, timeout=30)
+        connection.text_factory = str
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @classmethod
+    def _address_keys(cls, payload_df):
+        """
+        :param payload_df: A dataframe as returned by GeocodingJob._build_payload_df
+        :return: A series of cache keys, one per payload row
+        """
+        keys = payload_df[cls.KEY_COLUMNS[0]].astype(str)
+        for column in cls.KEY_COLUMNS[1:]:
+            keys = keys + cls._KEY_SEPARATOR + payload_df[column].astype(str)
+        return keys
@@ -0,0 +1,80 @@
+import unittest
+import os
+import shutil
+import tempfile
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.key_scheduler import KeyScheduler
+from geocoding_job.polling_policy import PollingPolicy
+from geocoding_job.cli import geocode_file, read_input_chunks, main
+from benchmarks.local_dataflow_server import LocalDataflowServer
+from benchmarks.benchmark_geocoding_job import generate_input
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.directory, 'input.csv')
+        generate_input(25).to_csv(self.input_path, index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_input_read_in_chunks(self):
+        chunks = list(read_input_chunks(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 2, delimiter=";"))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(list(chunks[0]["postcode"]), ["01300", "00100"])
+
+    def test_file_geocoded_in_chunks(self):
+        output_path = os.path.join(self.directory, 'output.csv')
+        created = []
+
+        def _job_factory(data, **kwargs):
+            created.append(len(data))
+            return GeocodingJob(data, **kwargs)
+
+        with LocalDataflowServer(seed=1) as server:
+            row_count = geocode_file(self.input_path, output_path, bing_key="test", chunk_size=10,
+                                     max_concurrent_jobs=2, result_schema=GeocodingJob.COMPACT_RESULT_SCHEMA,
+                                     job_factory=_job_factory, dataflow_url=server.dataflow_url,
+                                     polling_policy=PollingPolicy(initial_interval_seconds=0.05))
+        self.assertEqual(row_count, 25)
+        self.assertEqual(created, [10, 10, 5])
+        results = pandas.read_csv(output_path)
+        self.assertEqual(list(results["Id"]), list(range(25)))
+        self.assertEqual(sorted(results.columns), sorted(GeocodingJob.COMPACT_RESULT_SCHEMA))
+        self.assertTrue(results["GeocodeResponse/Point/Latitude"].between(59, 71).all())
+
+    def test_main(self):
+        output_path = os.path.join(self.directory, 'output.csv')
+        with LocalDataflowServer(seed=1) as server:
+            self.assertEqual(main([self.input_path, output_path, "--bing-key", "test", "--chunk-size", "20",
+                                   "--result-schema", "full", "--compress-upload", "--payload-format", "csv",
+                                   "--dataflow-url", server.dataflow_url]), 0)
+        results = pandas.read_csv(output_path)
+        self.assertEqual(len(results), 25)
+        self.assertEqual(list(results.columns), GeocodingJob.DEFAULT_PAYLOAD_HEADERS)
+
+    def test_main_with_several_keys(self):
+        output_path = os.path.join(self.directory, 'output.csv')
+        key_state_path = os.path.join(self.directory, 'keys.sqlite')
+        with LocalDataflowServer(seed=1) as server:
+            self.assertEqual(main([self.input_path, output_path, "--bing-key", "a", "--bing-key", "b",
+                                   "--key-state", key_state_path, "--max-concurrent-jobs-per-key", "1",
+                                   "--chunk-size", "5", "--dataflow-url", server.dataflow_url]), 0)
+        self.assertEqual(len(pandas.read_csv(output_path)), 25)
+        self.assertEqual(KeyScheduler(["a", "b"], key_state_path).running_jobs(), {"a": 0, "b": 0})
+
+    def test_main_key_wait_timeout(self):
+        key_state_path = os.path.join(self.directory, 'keys.sqlite')
+        with KeyScheduler(["a"], key_state_path, max_concurrent_jobs_per_key=1).lease(1):
+            with self.assertRaises(GeocodingJob.GeocodingException):
+                main([self.input_path, os.path.join(self.directory, 'output.csv'), "--bing-key", "a",
+                      "--key-state", key_state_path, "--max-concurrent-jobs-per-key", "1",
+                      "--key-wait-timeout", "0"])
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            geocode_file(self.input_path, os.path.join(self.directory, 'output.csv'), bing_key="test",
+                         chunk_size=GeocodingJob.MAX_ENTITIES_PER_JOB + 1)
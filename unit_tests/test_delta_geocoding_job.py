@@ -0,0 +1,67 @@
+import unittest
+import os
+import shutil
+import tempfile
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.delta_geocoding_job import DeltaGeocodingJob
+from geocoding_job.polling_policy import PollingPolicy
+from benchmarks.local_dataflow_server import LocalDataflowServer
+from benchmarks.benchmark_geocoding_job import generate_input
+
+
+class TestDeltaGeocodingJob(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.directory, 'snapshot.pickle')
+        self.polling_policy = PollingPolicy(initial_interval_seconds=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _run(self, server, data, **kwargs):
+        job = DeltaGeocodingJob(data, self.snapshot_path, bing_key="test", dataflow_url=server.dataflow_url,
+                                polling_policy=self.polling_policy, **kwargs)
+        return job, job.fetch_results(GeocodingJob.COMPACT_RESULT_SCHEMA)
+
+    def _submitted_rows(self, server):
+        return sum(job['total'] for job in server.jobs.values())
+
+    def test_only_changes_geocoded(self):
+        data = generate_input(20)
+        with LocalDataflowServer(seed=1) as server:
+            job, results = self._run(server, data)
+            self.assertEqual(len(job.new_ids), 20)
+            self.assertEqual(sorted(results["Id"]), list(range(20)))
+            self.assertEqual(self._submitted_rows(server), 20)
+
+            changed = data[data["id"] != 5].copy()
+            changed.loc[changed["id"] == 3, "streetAddress"] = "Uusi katu 1"
+            changed = changed.append(generate_input(1).assign(id=100), ignore_index=True)
+            job, results = self._run(server, changed)
+            self.assertEqual(list(job.new_ids), [100])
+            self.assertEqual(list(job.changed_ids), [3])
+            self.assertEqual(list(job.deleted_ids), [5])
+            self.assertEqual(self._submitted_rows(server), 22)
+            self.assertEqual(sorted(results["Id"]), sorted(changed["id"]))
+            self.assertEqual(results[results["Id"] == 3]["GeocodeResponse/Address/AddressLine"].values[0],
+                             "Uusi katu 1")
+
+            job, results = self._run(server, changed)
+            self.assertEqual(len(job.new_ids) + len(job.changed_ids) + len(job.deleted_ids), 0)
+            self.assertEqual(self._submitted_rows(server), 22)
+            self.assertEqual(len(results), 20)
+
+    def test_failed_rows_geocoded_again(self):
+        data = generate_input(5)
+        with LocalDataflowServer(row_failure_rate=1.0, seed=1) as server:
+            _, results = self._run(server, data, failed_row_retries=0)
+        self.assertTrue((results["StatusCode"] == "ServerError").all())
+        with LocalDataflowServer(seed=1) as server:
+            job, results = self._run(server, data)
+            self.assertEqual(list(job.changed_ids), list(range(5)))
+            self.assertEqual(self._submitted_rows(server), 5)
+        self.assertTrue((results["StatusCode"] == "Success").all())
+
+    def test_duplicate_ids(self):
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            DeltaGeocodingJob(generate_input(3).assign(id=1), self.snapshot_path)
@@ -1,5 +1,7 @@
 import unittest
 import os
+import shutil
+import tempfile
 from StringIO import StringIO
 import pandas
 from test_data import TEST_DATA_DIR
@@ -7,6 +9,7 @@ from geocoding_job.geocoding_job import GeocodingJob
 import requests_mock
 import json
 import re
+import xml.etree.ElementTree as ElementTree
 
 STATUS_RESPONSE_CONTENT = json.dumps(
     {'resourceSets':
@@ -23,10 +26,39 @@ STATUS_RESPONSE_CONTENT = json.dumps(
           ]
      })
 
+PENDING_STATUS_RESPONSE_CONTENT = json.dumps(
+    {'resourceSets':
+         [{'resources':
+               [{'id': 'abc123', 'status': 'Pending', 'links':
+                    [{'role': 'self',
+                      'url': 'http://spatial.virtualearth.net/foo/abc123'
+                      }
+                     ]
+                 }
+                ]
+           }
+          ]
+     })
+
 
 with open(os.path.join(TEST_DATA_DIR,  'bing_example_response.csv')) as csvfile:
     TEST_BING_CSV_RESPONSE = csvfile.read()
 
+with open(os.path.join(TEST_DATA_DIR,  'bing_example_response.xml')) as xmlfile:
+    TEST_BING_XML_RESPONSE = xmlfile.read()
+
+
+def _completed_status(job_id, outputs):
+    return json.dumps({'resourceSets': [{'resources': [{'id': job_id, 'status': 'Completed', 'links': [
+        {'role': 'output', 'name': name, 'url': 'http://spatial.virtualearth.net/{}/output/{}'.format(job_id, name)}
+        for name in outputs]}]}]})
+
+
+def _output_csv(ids, **values):
+    rows = pandas.read_csv(StringIO(TEST_BING_CSV_RESPONSE), header=1)
+    rows = rows[rows["Id"].isin(ids)].assign(**values)
+    return "Bing Spatial Data Services, 2.0\n" + rows.to_csv(index=False)
+
 
 class TestGeocodingData(unittest.TestCase):
     def setUp(self):
@@ -37,6 +69,18 @@ class TestGeocodingData(unittest.TestCase):
         gc = GeocodingJob(self.test_data)
         self.assertTrue(isinstance(gc, GeocodingJob))
 
+    def test_request_payload(self):
+        payload_df = GeocodingJob._build_payload_df(self.test_data)
+        self.assertEqual(list(payload_df.columns), GeocodingJob.BING_POPULATED_REQUEST_HEADERS)
+        self.assertEqual(list(payload_df["GeocodeRequest/Address/PostalCode"]), ["01300", "00100", "33100"])
+        self.assertEqual(payload_df["GeocodeRequest/Address/Locality"][1], "")
+
+        payload = pandas.read_csv(StringIO("".join(GeocodingJob._build_bing_request_payload(
+            payload_df, GeocodingJob.DEFAULT_PAYLOAD_HEADERS))), header=1, dtype=str)
+        self.assertEqual(list(payload.columns), GeocodingJob.DEFAULT_PAYLOAD_HEADERS)
+        self.assertEqual(list(payload["GeocodeRequest/Address/PostalCode"]), ["01300", "00100", "33100"])
+        self.assertTrue(payload["GeocodeResponse/Point/Latitude"].isnull().all())
+
     @requests_mock.Mocker()
     def test_mock_data_works(self, mocker):
         matcher = re.compile("spatial.virtualearth.net")
@@ -49,6 +93,151 @@ class TestGeocodingData(unittest.TestCase):
         self.assertEqual(results[results["Id"] == 4]["GeocodeResponse/Address/Locality"].values[0], "Vantaa")
         self.assertEqual(results[results["Id"] == 7]["GeocodeResponse/Address/Locality"].values[0], "Helsinki")
 
+    @requests_mock.Mocker()
+    def test_submit_poll_collect(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=PENDING_STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("foo/abc123"), [{'text': PENDING_STATUS_RESPONSE_CONTENT},
+                                              {'text': STATUS_RESPONSE_CONTENT}])
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        gc = GeocodingJob(self.test_data)
+        handle = gc.submit()
+        self.assertEqual(handle.job_id, 'abc123')
+        self.assertFalse(gc.poll())
+        self.assertEqual(gc.status, GeocodingJob.GCStatus.pending)
+        self.assertTrue(gc.poll())
+        results = gc.collect()
+        self.assertEqual(gc.status, GeocodingJob.GCStatus.completed)
+        self.assertEqual(results[results["Id"] == 4]["GeocodeResponse/Address/Locality"].values[0], "Vantaa")
+
+    @requests_mock.Mocker()
+    def test_compact_result_schema(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        results = GeocodingJob(self.test_data).fetch_results(result_schema=GeocodingJob.COMPACT_RESULT_SCHEMA)
+        self.assertEqual(sorted(results.columns), sorted(GeocodingJob.COMPACT_RESULT_SCHEMA))
+        self.assertEqual(str(results["GeocodeResponse/Address/Locality"].dtype), "category")
+        self.assertEqual(str(results["GeocodeResponse/Point/Latitude"].dtype), "float32")
+        self.assertEqual(str(results["Id"].dtype), "int64")
+        self.assertEqual(results[results["Id"] == 13]["GeocodeResponse/Address/Locality"].values[0], "Tampere")
+
+    @requests_mock.Mocker()
+    def test_duplicate_addresses_sent_once(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        duplicates = self.test_data[self.test_data["id"] != 7].assign(id=[20, 21])
+        data = pandas.concat([self.test_data, duplicates], ignore_index=True)
+        gc = GeocodingJob(data, deduplicate=True)
+        self.assertEqual(list(gc._payload_df["Id"]), [4, 7, 13])
+        results = gc.fetch_results(result_schema=GeocodingJob.COMPACT_RESULT_SCHEMA)
+        self.assertEqual(sorted(results["Id"]), [4, 7, 13, 20, 21])
+        self.assertEqual(results[results["Id"] == 20]["GeocodeResponse/Address/Locality"].values[0], "Vantaa")
+        self.assertEqual(results[results["Id"] == 21]["GeocodeResponse/Address/Locality"].values[0], "Tampere")
+        self.assertEqual(str(results["GeocodeResponse/Address/Locality"].dtype), "category")
+
+    @requests_mock.Mocker()
+    def test_failed_rows_resubmitted(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"),
+                    [{'text': _completed_status('first', ['succeeded', 'failed'])},
+                     {'text': _completed_status('retry', ['succeeded', 'failed'])}])
+        mocker.get(re.compile("first/output/succeeded"), text=_output_csv([4]))
+        mocker.get(re.compile("first/output/failed"),
+                   text=_output_csv([7, 13], StatusCode="ServerError", FaultReason="Transient"))
+        mocker.get(re.compile("retry/output/succeeded"), text=_output_csv([7]))
+        mocker.get(re.compile("retry/output/failed"),
+                   text=_output_csv([13], StatusCode="BadRequest", FaultReason="Invalid address"))
+        gc = GeocodingJob(self.test_data, job_name="failing")
+        results = gc.fetch_results()
+        self.assertEqual(sorted(results["Id"]), [4, 7, 13])
+        self.assertEqual(results[results["Id"] == 7]["GeocodeResponse/Address/Locality"].values[0], "Helsinki")
+        self.assertEqual(results[results["Id"] == 13]["StatusCode"].values[0], "BadRequest")
+        retry_payload = pandas.read_csv(StringIO("".join(mocker.request_history[3].body)), header=1)
+        self.assertEqual(list(retry_payload["Id"]), [7, 13])
+        self.assertEqual(mocker.call_count, 6)
+
+    @requests_mock.Mocker()
+    def test_failed_rows_not_resubmitted_without_retries(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=json.dumps(
+            {'resourceSets': [{'resources': [{'status': 'Completed', 'links': [
+                {'role': 'output', 'name': name, 'url': 'http://spatial.virtualearth.net/foo/output/' + name}
+                for name in ['succeeded', 'failed']]}]}]}))
+        rows = pandas.read_csv(StringIO(TEST_BING_CSV_RESPONSE), header=1)
+        mocker.get(re.compile("output/succeeded"),
+                   text="Bing Spatial Data Services, 2.0\n" + rows[rows["Id"] != 7].to_csv(index=False))
+        mocker.get(re.compile("output/failed"), text="Bing Spatial Data Services, 2.0\n" +
+                   rows[rows["Id"] == 7].assign(StatusCode="ServerError").to_csv(index=False))
+        results = GeocodingJob(self.test_data, failed_row_retries=0).fetch_results()
+        self.assertEqual(sorted(results["Id"]), [4, 7, 13])
+        self.assertEqual(results[results["Id"] == 7]["StatusCode"].values[0], "ServerError")
+        self.assertEqual(mocker.call_count, 3)
+
+    @requests_mock.Mocker()
+    def test_results_streamed_in_chunks(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        gc = GeocodingJob(self.test_data)
+        gc.submit()
+        self.assertTrue(gc.poll())
+        chunks = list(gc.collect_chunks(chunksize=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(gc.status, GeocodingJob.GCStatus.completed)
+
+    @requests_mock.Mocker()
+    def test_results_streamed_to_file(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        result_dir = tempfile.mkdtemp()
+        try:
+            gc = GeocodingJob(self.test_data)
+            gc.submit()
+            gc.poll()
+            self.assertEqual(gc.collect_to_file(os.path.join(result_dir, 'results.csv'), chunksize=1), 3)
+            results = pandas.read_csv(os.path.join(result_dir, 'results.csv'))
+        finally:
+            shutil.rmtree(result_dir)
+        self.assertEqual(results[results["Id"] == 7]["GeocodeResponse/Address/Locality"].values[0], "Helsinki")
+
+    def test_xml_request_payload(self):
+        data = self.test_data.copy()
+        data.loc[0, "streetAddress"] = 'Kuja "A" & <B>'
+        payload = "".join(GeocodingJob._build_bing_xml_request_payload(GeocodingJob._build_payload_df(data)))
+        entities = ElementTree.fromstring(payload)
+        namespace = "{" + GeocodingJob._XML_NAMESPACE + "}"
+        self.assertEqual([entity.get("Id") for entity in entities], ["4", "7", "13"])
+        addresses = [entity.find(namespace + "GeocodeRequest/" + namespace + "Address") for entity in entities]
+        self.assertEqual(addresses[0].get("AddressLine"), 'Kuja "A" & <B>')
+        self.assertEqual(addresses[1].get("PostalCode"), "00100")
+        self.assertEqual(addresses[1].get("Locality"), "")
+
+    @requests_mock.Mocker()
+    def test_xml_results_match_csv(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), content=TEST_BING_XML_RESPONSE)
+        gc = GeocodingJob(self.test_data, input_format="xml")
+        results = gc.fetch_results()
+        self.assertIn("input=xml", mocker.request_history[0].url)
+        self.assertTrue(mocker.request_history[0].headers['content-type'].startswith("application/xml"))
+        self.assertEqual(list(results.columns), GeocodingJob.DEFAULT_PAYLOAD_HEADERS)
+        self.assertEqual(list(results["Id"]), [4, 13, 7])
+        csv_results = pandas.read_csv(StringIO(TEST_BING_CSV_RESPONSE), header=1).set_index("Id").loc[[4, 13, 7]]
+        for column in ["GeocodeResponse/Point/Latitude", "GeocodeResponse/BoundingBox/NorthLatitude",
+                       "GeocodeResponse/Address/Locality", "GeocodeResponse/Confidence", "StatusCode"]:
+            self.assertEqual(list(results[column]), list(csv_results[column]))
+        points = json.loads(results["GeocodeResponse/GeocodePoints"][0])
+        self.assertEqual([point["UsageTypes"] for point in points], ["Display", "Route"])
+
+    @requests_mock.Mocker()
+    def test_xml_results_streamed_in_chunks(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), content=TEST_BING_XML_RESPONSE)
+        gc = GeocodingJob(self.test_data, input_format="xml")
+        gc.submit()
+        gc.poll()
+        chunks = list(gc.collect_chunks(chunksize=2, result_schema=GeocodingJob.COMPACT_RESULT_SCHEMA))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(str(chunks[0]["GeocodeResponse/Point/Latitude"].dtype), "float32")
+        self.assertEqual(list(chunks[1]["Id"]), [7])
+        self.assertEqual(chunks[0]["GeocodeResponse/Address/PostalCode"][0], "01300")
+
     def test_live_data_fetched(self):
         gc = GeocodingJob(self.test_data)
         results = gc.fetch_results()
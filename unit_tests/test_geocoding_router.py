@@ -0,0 +1,103 @@
+import unittest
+import os
+from StringIO import StringIO
+import pandas
+import requests
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.geocoding_router import GeocodingRouter
+from unit_tests.test_multi_geocoding_job import _create_job_callback, _output_callback
+import requests_mock
+import json
+import re
+
+
+def _locations_callback(request, context):
+    """Responds with a location in the locality of the request, or no location if the locality is missing."""
+    locality = request.qs.get("locality", [""])[0]
+    resources = [{'name': 'Test location', 'point': {'type': 'Point', 'coordinates': [60.29, 25.04]},
+                  'bbox': [60.28, 25.03, 60.30, 25.05], 'entityType': 'Address', 'confidence': 'High',
+                  'matchCodes': ['Good'],
+                  'address': {'addressLine': request.qs["addressline"][0], 'locality': locality,
+                              'postalCode': request.qs["postalcode"][0], 'countryRegion': 'Finland',
+                              'formattedAddress': 'Test location, Finland'},
+                  'geocodePoints': [{'type': 'Point', 'coordinates': [60.29, 25.04], 'calculationMethod': 'Rooftop',
+                                     'usageTypes': ['Display', 'Route']}]}] if locality else []
+    return json.dumps({'statusCode': 200, 'traceId': 'trace', 'resourceSets': [{'resources': resources}]})
+
+
+class TestGeocodingRouter(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+
+    def _router(self, **kwargs):
+        # A session without retries, so that the error responses are not retried.
+        return GeocodingRouter(bing_key="test", session=requests.Session(), **kwargs)
+
+    def _mock_dataflow(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=_create_job_callback)
+        mocker.get(re.compile("output/succeeded"), text=_output_callback)
+
+    @requests_mock.Mocker()
+    def test_small_batch_geocoded_per_address(self, mocker):
+        mocker.get(re.compile("dev.virtualearth.net/REST/v1/Locations"), text=_locations_callback)
+        results = self._router(row_threshold=3).geocode(self.test_data)
+        self.assertEqual(len(mocker.request_history), 3)
+        self.assertEqual(mocker.request_history[0].qs["culture"], ["fi-fi"])
+        self.assertEqual(list(results.columns), GeocodingJob.DEFAULT_PAYLOAD_HEADERS)
+        self.assertEqual(sorted(results["Id"]), [4, 7, 13])
+        self.assertTrue((results["StatusCode"] == "Success").all())
+        vantaa = results[results["Id"] == 4].iloc[0]
+        self.assertEqual(vantaa["GeocodeResponse/Address/Locality"], "vantaa")
+        self.assertEqual(vantaa["GeocodeResponse/Point/Latitude"], 60.29)
+        self.assertEqual(vantaa["GeocodeResponse/BoundingBox/EastLongitude"], 25.05)
+        self.assertEqual(json.loads(vantaa["GeocodeResponse/GeocodePoints"])[0]["UsageTypes"], "Display,Route")
+        # The row without a locality has no match, like a Dataflow row Bing could not geocode.
+        self.assertTrue(pandas.isnull(results[results["Id"] == 7]["GeocodeResponse/Point/Latitude"].values[0]))
+
+    @requests_mock.Mocker()
+    def test_large_batch_geocoded_with_dataflow(self, mocker):
+        self._mock_dataflow(mocker)
+        router = self._router(row_threshold=2)
+        self.assertFalse(router.uses_locations_api(3))
+        results = router.geocode(self.test_data)
+        self.assertFalse(any("Locations" in request.url for request in mocker.request_history))
+        self.assertEqual(sorted(results["Id"]), [4, 7, 13])
+
+    @requests_mock.Mocker()
+    def test_urgent_batch_geocoded_per_address(self, mocker):
+        mocker.get(re.compile("dev.virtualearth.net/REST/v1/Locations"), text=_locations_callback)
+        router = self._router(row_threshold=0, dataflow_latency_seconds=30)
+        self.assertFalse(router.uses_locations_api(3, deadline_seconds=60))
+        self.assertTrue(router.uses_locations_api(3, deadline_seconds=10))
+        results = router.geocode(self.test_data, deadline_seconds=10)
+        self.assertEqual(len(mocker.request_history), 3)
+        self.assertTrue((results["StatusCode"] == "Success").all())
+
+    @requests_mock.Mocker()
+    def test_same_schema_on_both_paths(self, mocker):
+        self._mock_dataflow(mocker)
+        mocker.get(re.compile("dev.virtualearth.net/REST/v1/Locations"), text=_locations_callback)
+        per_address = self._router(row_threshold=3).geocode(self.test_data, GeocodingJob.COMPACT_RESULT_SCHEMA)
+        dataflow = self._router(row_threshold=0).geocode(self.test_data, GeocodingJob.COMPACT_RESULT_SCHEMA)
+        self.assertEqual(list(per_address.columns), list(dataflow.columns))
+        self.assertEqual([dtype.name for dtype in per_address.dtypes], [dtype.name for dtype in dataflow.dtypes])
+        # The Locations API finds no match for the row without a locality, see _locations_callback.
+        postal_codes = [results.set_index("Id").loc[[4, 13], "GeocodeResponse/Address/PostalCode"].tolist()
+                        for results in (per_address, dataflow)]
+        self.assertEqual(postal_codes, [["01300", "33100"]] * 2)
+        self.assertTrue(all(isinstance(postal_code, str) for postal_code in postal_codes[0]))
+
+    @requests_mock.Mocker()
+    def test_failed_requests(self, mocker):
+        mocker.get(re.compile("Locations.*addressLine=Kuninkaalantie"), status_code=500)
+        mocker.get(re.compile("Locations.*addressLine=Urho"), status_code=400)
+        mocker.get(re.compile("Locations.*addressLine=Yliopistonkatu"), exc=requests.exceptions.ConnectTimeout)
+        results = self._router().geocode(self.test_data).set_index("Id")
+        self.assertEqual(list(results.loc[[4, 7, 13], "StatusCode"]), ["ServerError", "BadRequest", "Timeout"])
+        self.assertTrue(results["FaultReason"].notnull().all())
+
+    def test_deadline_passed(self):
+        results = self._router().geocode(self.test_data, deadline_seconds=-1)
+        self.assertTrue((results["StatusCode"] == "Timeout").all())
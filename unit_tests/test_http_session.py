@@ -0,0 +1,54 @@
+import unittest
+import os
+import socket
+import time
+from StringIO import StringIO
+import pandas
+import requests
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.http_session import create_session
+from unit_tests.test_geocoding_job import STATUS_RESPONSE_CONTENT, TEST_BING_CSV_RESPONSE
+import requests_mock
+import re
+
+
+class TestHttpSession(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+
+    def test_retry_policy(self):
+        adapter = create_session(pool_size=5, retries=2).get_adapter("http://spatial.virtualearth.net")
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertTrue(adapter.max_retries.is_retry('GET', 503))
+        self.assertFalse(adapter.max_retries.is_retry('POST', 503))
+
+    def test_jobs_use_the_shared_session(self):
+        adapter = requests_mock.Adapter()
+        adapter.register_uri('POST', re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        adapter.register_uri('GET', re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        for _ in range(2):
+            results = GeocodingJob(self.test_data, session=session).fetch_results()
+            self.assertEqual(len(results), 3)
+        self.assertEqual(adapter.call_count, 4)
+        self.assertEqual(adapter.request_history[0].timeout, GeocodingJob.DEFAULT_TIMEOUTS.upload)
+        self.assertEqual(adapter.request_history[1].timeout, GeocodingJob.DEFAULT_TIMEOUTS.download)
+
+    def test_upload_timeout(self):
+        # A server that accepts connections but never reads the request or answers it.
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        try:
+            job = GeocodingJob(self.test_data, bing_key="test",
+                               dataflow_url="http://127.0.0.1:{}/Geocode".format(server.getsockname()[1]),
+                               timeouts=GeocodingJob.Timeouts(upload=(1, 1), status=(1, 1), download=(1, 1)))
+            started = time.time()
+            with self.assertRaises(requests.exceptions.Timeout):
+                job.submit()
+            self.assertTrue(time.time() - started < 5)
+        finally:
+            server.close()
@@ -0,0 +1,61 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.instrumentation import Instrumentation, JsonLinesExporter, MetricsCollector
+from unit_tests.test_geocoding_job import STATUS_RESPONSE_CONTENT, TEST_BING_CSV_RESPONSE
+import requests_mock
+import re
+
+
+def _consume_upload(request, context):
+    """Reads the streamed request payload like a real server would, so that the upload bytes get counted."""
+    "".join(request.body)
+    return STATUS_RESPONSE_CONTENT
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.metrics_dir)
+
+    @requests_mock.Mocker()
+    def test_metrics_collected_and_exported(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=_consume_upload)
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        collector = MetricsCollector()
+        GeocodingJob(self.test_data, instrumentation=collector).fetch_results()
+
+        self.assertEqual(collector.counters, {'rows_submitted': 3, 'rows_succeeded': 3, 'rows_failed': 0})
+        self.assertEqual(collector.phase_counts['upload'], 1)
+        self.assertTrue(collector.phase_bytes['upload'] > 0)
+        self.assertEqual(collector.phase_bytes['download'], len(TEST_BING_CSV_RESPONSE))
+        self.assertEqual(collector.phase_counts['poll'], 0)
+
+        path = os.path.join(self.metrics_dir, 'geocoding.prom')
+        collector.write_prometheus(path)
+        with open(path) as metrics_file:
+            text = metrics_file.read()
+        self.assertIn('geocoding_job_rows_total{outcome="succeeded"} 3', text)
+        self.assertIn('geocoding_job_phase_seconds_count{phase="parse"} 1', text)
+
+    @requests_mock.Mocker()
+    def test_json_lines_exporter(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        path = os.path.join(self.metrics_dir, 'events.jsonl')
+        GeocodingJob(self.test_data, instrumentation=JsonLinesExporter(path), job_name='nightly').fetch_results()
+        with open(path) as events_file:
+            events = [json.loads(line) for line in events_file]
+        self.assertTrue(all(event['job_name'] == 'nightly' for event in events))
+        self.assertEqual([event['phase'] for event in events if event['event'] == 'timing'],
+                         [phase for phase in Instrumentation.PHASES if phase != 'poll'])
@@ -0,0 +1,105 @@
+import unittest
+import os
+from StringIO import StringIO
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.job_coordinator import JobCoordinator
+from geocoding_job.polling_policy import PollingPolicy
+from unit_tests.test_geocoding_job import (PENDING_STATUS_RESPONSE_CONTENT, STATUS_RESPONSE_CONTENT,
+                                           TEST_BING_CSV_RESPONSE, _completed_status, _output_csv)
+import requests
+import requests_mock
+import re
+
+
+class TestJobCoordinator(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+
+    @requests_mock.Mocker()
+    def test_results_yielded_as_jobs_complete(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), [{'text': PENDING_STATUS_RESPONSE_CONTENT},
+                                                             {'text': STATUS_RESPONSE_CONTENT}])
+        mocker.get(re.compile("foo/abc123"), [{'text': PENDING_STATUS_RESPONSE_CONTENT},
+                                              {'text': STATUS_RESPONSE_CONTENT}])
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        pending_job = GeocodingJob(self.test_data, polling_policy=PollingPolicy(initial_interval_seconds=0))
+        completed_job = GeocodingJob(self.test_data)
+        coordinator = JobCoordinator(batch_window_seconds=0)
+        coordinator.add(pending_job)
+        coordinator.add(completed_job)
+        self.assertEqual(len(coordinator), 2)
+        completed = [(job, df) for job, df in coordinator.as_completed()]
+        self.assertEqual([job for job, _ in completed], [completed_job, pending_job])
+        self.assertTrue(all(len(df) == 3 for _, df in completed))
+        self.assertEqual(len(coordinator), 0)
+        self.assertEqual(coordinator.failed, [])
+
+    @requests_mock.Mocker()
+    def test_retry_jobs_polled_alongside_the_others(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), [
+            {'text': _completed_status('first', ['succeeded', 'failed'])}, {'text': PENDING_STATUS_RESPONSE_CONTENT},
+            {'text': _completed_status('retry', ['succeeded'])}])
+        mocker.get(re.compile("first/output/succeeded"), text=_output_csv([4]))
+        mocker.get(re.compile("first/output/failed"), text=_output_csv([7, 13], StatusCode="ServerError"))
+        mocker.get(re.compile("retry/output/succeeded"), text=_output_csv([7, 13]))
+        mocker.get(re.compile("foo/abc123"), [{'text': PENDING_STATUS_RESPONSE_CONTENT},
+                                              {'text': STATUS_RESPONSE_CONTENT}])
+        mocker.get(re.compile("foo/output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        polling_policy = PollingPolicy(initial_interval_seconds=0)
+        failing_job = GeocodingJob(self.test_data, polling_policy=polling_policy)
+        other_job = GeocodingJob(self.test_data, polling_policy=polling_policy)
+        coordinator = JobCoordinator(batch_window_seconds=0)
+        coordinator.add(failing_job)
+        coordinator.add(other_job)
+        completed = dict(coordinator.as_completed())
+        self.assertEqual(set(completed), {failing_job, failing_job.retry_job, other_job})
+        self.assertEqual(list(completed[failing_job]["Id"]), [4])
+        self.assertEqual(sorted(completed[failing_job.retry_job]["Id"]), [7, 13])
+        self.assertEqual(len(completed[other_job]), 3)
+
+    @requests_mock.Mocker()
+    def test_network_errors_do_not_lose_jobs(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=PENDING_STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("foo/abc123"), [{'exc': requests.exceptions.ConnectionError},
+                                              {'text': PENDING_STATUS_RESPONSE_CONTENT},
+                                              {'text': STATUS_RESPONSE_CONTENT}])
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        # A session without retries, so that the connection error reaches the coordinator.
+        jobs = [GeocodingJob(self.test_data, session=requests.Session(),
+                             polling_policy=PollingPolicy(initial_interval_seconds=0)) for _ in range(3)]
+        coordinator = JobCoordinator(batch_window_seconds=0)
+        for job in jobs:
+            coordinator.add(job)
+        completed = [job for job, _ in coordinator.as_completed()]
+        self.assertEqual(sorted(completed), sorted(jobs))
+        self.assertEqual(coordinator.failed, [])
+
+    @requests_mock.Mocker()
+    def test_job_failed_after_repeated_network_errors(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=PENDING_STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("foo/abc123"), exc=requests.exceptions.ConnectionError)
+        job = GeocodingJob(self.test_data, session=requests.Session(),
+                           polling_policy=PollingPolicy(initial_interval_seconds=0))
+        coordinator = JobCoordinator(batch_window_seconds=0, max_request_errors=3)
+        coordinator.add(job)
+        self.assertEqual(list(coordinator.as_completed()), [])
+        self.assertEqual(coordinator.failed, [job])
+        self.assertEqual(mocker.call_count, 4)
+
+    @requests_mock.Mocker()
+    def test_unexpected_errors_do_not_lose_jobs(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), [{'text': 'not, a\nBing, response\n"'},
+                                                    {'text': TEST_BING_CSV_RESPONSE}])
+        jobs = [GeocodingJob(self.test_data) for _ in range(3)]
+        coordinator = JobCoordinator(batch_window_seconds=0)
+        for job in jobs:
+            coordinator.add(job)
+        iterator = coordinator.as_completed()
+        with self.assertRaises(Exception):
+            next(iterator)
+        self.assertEqual(len(coordinator), 3)
+        self.assertEqual(len(list(coordinator.as_completed())), 3)
@@ -0,0 +1,84 @@
+import unittest
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.job_journal import JobJournal
+from geocoding_job.result_cache import ResultCache
+from unit_tests.test_geocoding_job import (PENDING_STATUS_RESPONSE_CONTENT, STATUS_RESPONSE_CONTENT,
+                                           TEST_BING_CSV_RESPONSE)
+import requests_mock
+import re
+
+
+class TestJobJournal(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+        self.journal_dir = tempfile.mkdtemp()
+        self.journal = JobJournal(os.path.join(self.journal_dir, 'journal.jsonl'))
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+    @requests_mock.Mocker()
+    def test_pending_job_resumed(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=PENDING_STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("foo/abc123"), text=PENDING_STATUS_RESPONSE_CONTENT)
+        gc = GeocodingJob(self.test_data, journal=self.journal, job_name='nightly')
+        gc.submit()
+        gc.poll()
+        self.assertEqual(self.journal.last_entry('nightly')['status'], 'pending')
+        self.assertEqual(self.journal.unfinished_job_names(), ['nightly'])
+
+        # The process is restarted here; the job is picked up from the journal without resubmitting it.
+        mocker.get(re.compile("foo/abc123"), text=STATUS_RESPONSE_CONTENT)
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        resumed = GeocodingJob.resume(self.journal, 'nightly')
+        self.assertEqual(resumed.handle.job_id, 'abc123')
+        results = resumed.fetch_results()
+        self.assertEqual(len(results), 3)
+        self.assertEqual([request.method for request in mocker.request_history].count('POST'), 1)
+        self.assertEqual(self.journal.last_entry('nightly')['status'], 'completed')
+        self.assertEqual(self.journal.unfinished_job_names(), [])
+
+    def test_completed_output_downloaded_again(self):
+        self.journal.record('nightly', GeocodingJob.GCStatus.result_request_completed, job_id='abc123',
+                            status_url='http://spatial.virtualearth.net/foo/abc123',
+                            output_links={'succeeded': 'http://spatial.virtualearth.net/foo/output/succeeded'})
+        with requests_mock.Mocker() as mocker:
+            mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+            resumed = GeocodingJob.resume(self.journal, 'nightly')
+            self.assertEqual(resumed.status, GeocodingJob.GCStatus.bing_completed)
+            results = resumed.collect()
+        self.assertEqual(results[results["Id"] == 13]["GeocodeResponse/Address/Locality"].values[0], "Tampere")
+
+    def test_unknown_job_cannot_be_resumed(self):
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            GeocodingJob.resume(self.journal, 'nightly')
+
+    @requests_mock.Mocker()
+    def test_deduplicated_job_cannot_be_resumed(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=PENDING_STATUS_RESPONSE_CONTENT)
+        data = pandas.concat([self.test_data.iloc[:2]] * 2, ignore_index=True).assign(id=[1, 2, 3, 4])
+        GeocodingJob(data, journal=self.journal, job_name='nightly', deduplicate=True).submit()
+        self.assertEqual(self.journal.last_entry('nightly')['duplicate_rows'], 2)
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            GeocodingJob.resume(self.journal, 'nightly')
+
+    @requests_mock.Mocker()
+    def test_job_with_cached_rows_cannot_be_resumed(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=PENDING_STATUS_RESPONSE_CONTENT)
+        cache = ResultCache(os.path.join(self.journal_dir, 'cache.sqlite'))
+        cache.store(GeocodingJob._build_payload_df(self.test_data),
+                    pandas.read_csv(StringIO(TEST_BING_CSV_RESPONSE), header=1))
+        extended = self.test_data.append(pandas.DataFrame(
+            {'id': [99], 'streetAddress': ['Mannerheimintie 1'], 'postcode': ['00100'], 'municipality': ['Helsinki']}),
+            ignore_index=True, sort=False)
+        GeocodingJob(extended, journal=self.journal, job_name='nightly', cache=cache).submit()
+        self.assertEqual(self.journal.last_entry('nightly')['cached_rows'], 3)
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            GeocodingJob.resume(self.journal, 'nightly')
@@ -0,0 +1,140 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from StringIO import StringIO
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.key_scheduler import KeyScheduler
+from geocoding_job.multi_geocoding_job import MultiGeocodingJob
+from geocoding_job.polling_policy import PollingPolicy
+from benchmarks.local_dataflow_server import LocalDataflowServer
+from benchmarks.benchmark_geocoding_job import generate_input
+from unit_tests.test_multi_geocoding_job import _create_job_callback, _output_callback
+import requests_mock
+import re
+
+
+class TestKeyScheduler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'keys.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_work_spread_across_keys(self):
+        scheduler = KeyScheduler(["a", "b"], self.path, max_concurrent_jobs_per_key=2)
+        leases = [scheduler.acquire(10) for _ in range(4)]
+        self.assertEqual(sorted(lease.bing_key for lease in leases), ["a", "a", "b", "b"])
+        self.assertEqual(scheduler.running_jobs(), {"a": 2, "b": 2})
+        self.assertIsNone(scheduler.try_acquire(10))
+        scheduler.release(leases[0])
+        self.assertEqual(scheduler.try_acquire(10).bing_key, leases[0].bing_key)
+
+    def test_budget_shared_through_the_database(self):
+        first = KeyScheduler(["a"], self.path, max_concurrent_jobs_per_key=1)
+        second = KeyScheduler(["a"], self.path, max_concurrent_jobs_per_key=1)
+        with first.lease(10) as bing_key:
+            self.assertEqual(bing_key, "a")
+            self.assertIsNone(second.try_acquire(10))
+            with self.assertRaises(GeocodingJob.GeocodingException):
+                second.acquire(10, timeout_seconds=0)
+        self.assertIsNotNone(second.try_acquire(10))
+
+    def test_transaction_quota(self):
+        scheduler = KeyScheduler(["a", "b"], self.path, transactions_per_day=100)
+        self.assertEqual(scheduler.acquire(80).bing_key, "a")
+        # The key with the most transactions left is preferred when the keys are equally busy.
+        self.assertEqual(scheduler.acquire(60).bing_key, "b")
+        self.assertIsNone(scheduler.try_acquire(50))
+        self.assertEqual(scheduler.acquire(40).bing_key, "b")
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            scheduler.try_acquire(101)
+
+    def test_no_quota_leaves_the_buckets_alone(self):
+        scheduler = KeyScheduler(["a"], self.path)
+        for _ in range(5):
+            scheduler.release(scheduler.acquire(100))
+        self.assertEqual(KeyScheduler(["a"], self.path, transactions_per_day=100).try_acquire(100).bing_key, "a")
+
+    def test_transactions_charged_outside_leases(self):
+        scheduler = KeyScheduler(["a"], self.path, transactions_per_day=100)
+        scheduler.acquire(50)
+        scheduler.charge("a", 40)
+        self.assertIsNone(scheduler.try_acquire(20))
+        self.assertIsNotNone(scheduler.try_acquire(10))
+
+    def test_stale_leases_expire(self):
+        scheduler = KeyScheduler(["a"], self.path, max_concurrent_jobs_per_key=1, lease_ttl_seconds=0)
+        scheduler.acquire(1)
+        self.assertIsNotNone(scheduler.try_acquire(1))
+
+    def test_leases_of_dead_processes_reclaimed(self):
+        scheduler = KeyScheduler(["a"], self.path, max_concurrent_jobs_per_key=1)
+        scheduler.acquire(1)
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        connection = sqlite3.connect(self.path)
+        connection.execute("UPDATE leases SET pid = ?", (process.pid,))
+        connection.commit()
+        connection.close()
+        self.assertEqual(scheduler.running_jobs(), {"a": 0})
+        self.assertIsNotNone(scheduler.try_acquire(1))
+
+    def test_leases_of_live_and_remote_processes_kept(self):
+        scheduler = KeyScheduler(["a"], self.path, max_concurrent_jobs_per_key=2)
+        scheduler.acquire(1)
+        remote_lease = scheduler.acquire(1)
+        connection = sqlite3.connect(self.path)
+        connection.execute("UPDATE leases SET hostname = 'elsewhere', pid = -1 WHERE lease_id = ?",
+                           (remote_lease.lease_id,))
+        connection.commit()
+        connection.close()
+        self.assertEqual(scheduler.running_jobs(), {"a": 2})
+        self.assertIsNone(scheduler.try_acquire(1))
+
+    def test_database_without_lease_owners_upgraded(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE leases (lease_id TEXT PRIMARY KEY, bing_key TEXT NOT NULL, "
+                           "acquired REAL NOT NULL)")
+        connection.execute("INSERT INTO leases VALUES ('old', 'a', 0)")
+        connection.commit()
+        connection.close()
+        scheduler = KeyScheduler(["a"], self.path, max_concurrent_jobs_per_key=1)
+        # The lease of the old version has no owner, so only its ttl ends it.
+        self.assertEqual(scheduler.running_jobs(), {"a": 0})
+        self.assertIsNotNone(scheduler.try_acquire(1))
+        self.assertEqual(scheduler.running_jobs(), {"a": 1})
+
+    @requests_mock.Mocker()
+    def test_multi_geocoding_job_uses_the_keys(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=_create_job_callback)
+        mocker.get(re.compile("output/succeeded"), text=_output_callback)
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+        scheduler = KeyScheduler(["a", "b"], self.path, max_concurrent_jobs_per_key=1, wait_interval_seconds=0.01)
+        results = MultiGeocodingJob(test_data, chunk_size=1, max_concurrent_jobs=3,
+                                    key_scheduler=scheduler).fetch_results()
+        self.assertEqual(list(results["Id"]), [4, 7, 13])
+        used_keys = [request.qs['key'][0] for request in mocker.request_history if request.method == 'POST']
+        self.assertEqual(sorted(set(used_keys)), ["a", "b"])
+        self.assertEqual(scheduler.running_jobs(), {"a": 0, "b": 0})
+
+    def test_resubmitted_rows_charged_to_the_lease(self):
+        scheduler = KeyScheduler(["a"], self.path, transactions_per_day=1000)
+        with LocalDataflowServer(row_failure_rate=0.5, seed=1) as server:
+            results = MultiGeocodingJob(generate_input(20), chunk_size=10, key_scheduler=scheduler,
+                                        dataflow_url=server.dataflow_url,
+                                        polling_policy=PollingPolicy(initial_interval_seconds=0.05)).fetch_results()
+            submitted_rows = sum(job['total'] for job in server.jobs.values())
+        self.assertEqual(len(results), 20)
+        self.assertTrue(submitted_rows > 20)
+        connection = sqlite3.connect(self.path)
+        tokens = connection.execute("SELECT tokens FROM buckets WHERE bing_key = 'a'").fetchone()[0]
+        connection.close()
+        self.assertAlmostEqual(1000 - tokens, submitted_rows, delta=1)
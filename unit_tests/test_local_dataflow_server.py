@@ -0,0 +1,63 @@
+import unittest
+import os
+from StringIO import StringIO
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.polling_policy import PollingPolicy
+from geocoding_job.instrumentation import MetricsCollector
+from benchmarks.local_dataflow_server import LocalDataflowServer
+from benchmarks.benchmark_geocoding_job import run_benchmark, generate_input
+
+
+class TestLocalDataflowServer(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+        self.polling_policy = PollingPolicy(initial_interval_seconds=0.05)
+
+    def test_end_to_end(self):
+        with LocalDataflowServer(processing_seconds=0.2, seed=1) as server:
+            gc = GeocodingJob(self.test_data, dataflow_url=server.dataflow_url, polling_policy=self.polling_policy)
+            gc.submit()
+            self.assertFalse(gc.poll())
+            results = gc.fetch_results()
+        self.assertEqual(gc.status, GeocodingJob.GCStatus.completed)
+        self.assertEqual(sorted(results["Id"]), [4, 7, 13])
+        self.assertEqual(results[results["Id"] == 13]["GeocodeResponse/Address/Locality"].values[0], "Tampere")
+        self.assertTrue(results["GeocodeResponse/Point/Latitude"].between(59, 71).all())
+
+    def test_aborted_job(self):
+        with LocalDataflowServer(job_failure_rate=1.0) as server:
+            gc = GeocodingJob(self.test_data, dataflow_url=server.dataflow_url, polling_policy=self.polling_policy)
+            with self.assertRaises(GeocodingJob.GeocodingException):
+                gc.fetch_results()
+        self.assertEqual(gc.status, GeocodingJob.GCStatus.error)
+
+    def test_compressed_transfers(self):
+        data = generate_input(2000)
+        collectors = {}
+        with LocalDataflowServer(seed=1) as server:
+            for compress_upload in [False, True]:
+                collectors[compress_upload] = MetricsCollector()
+                gc = GeocodingJob(data, dataflow_url=server.dataflow_url, polling_policy=self.polling_policy,
+                                  compress_upload=compress_upload, instrumentation=collectors[compress_upload])
+                results = gc.fetch_results()
+                self.assertEqual(sorted(results["Id"]), list(range(2000)))
+                self.assertEqual(server.jobs[gc.handle.job_id]['compressed_upload'], compress_upload)
+        self.assertTrue(collectors[True].phase_bytes['upload'] * 5 < collectors[False].phase_bytes['upload'])
+        # The outputs are downloaded gzipped either way.
+        self.assertTrue(collectors[True].phase_bytes['download'] * 2 < len(server.jobs[gc.handle.job_id]['succeeded']))
+
+    def test_benchmark(self):
+        with LocalDataflowServer(processing_seconds=0.1) as server:
+            result = run_benchmark(500, server.dataflow_url)
+        self.assertEqual(result['result_rows'], 500)
+        self.assertTrue(result['rows_per_second'] > 0)
+        self.assertEqual(sorted(result['phase_seconds']), sorted(["build", "upload", "wait", "collect"]))
+
+    def test_benchmark_counts_resubmitted_rows(self):
+        with LocalDataflowServer(row_failure_rate=0.2, seed=1) as server:
+            result = run_benchmark(500, server.dataflow_url)
+            self.assertTrue(len(server.jobs) > 1)
+        self.assertEqual(result['result_rows'], 500)
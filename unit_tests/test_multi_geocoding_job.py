@@ -0,0 +1,49 @@
+import unittest
+import os
+from StringIO import StringIO
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.multi_geocoding_job import MultiGeocodingJob
+from unit_tests.test_geocoding_job import TEST_BING_CSV_RESPONSE
+import requests_mock
+import json
+import re
+
+
+def _create_job_callback(request, context):
+    """Responds to a job creation with a completed status whose output link names the submitted ids."""
+    # The request payload is uploaded as a SpooledBody, which is iterated in blocks of the csv.
+    payload = pandas.read_csv(StringIO("".join(request.body)), header=1)
+    ids = "-".join(str(job_id) for job_id in payload["Id"])
+    return json.dumps({'resourceSets': [{'resources': [{'status': 'Completed', 'links': [
+        {'name': 'succeeded', 'role': 'output',
+         'url': 'http://spatial.virtualearth.net/foo/output/succeeded/{}'.format(ids)}]}]}]})
+
+
+def _output_callback(request, context):
+    """Responds with the rows of the example response that were submitted in the job."""
+    ids = [int(job_id) for job_id in request.path.split("/")[-1].split("-")]
+    lines = TEST_BING_CSV_RESPONSE.splitlines(True)
+    return "".join(lines[:2] + [line for line in lines[2:] if int(line.split(",")[0]) in ids])
+
+
+class TestMultiGeocodingJob(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            MultiGeocodingJob(self.test_data, chunk_size=GeocodingJob.MAX_ENTITIES_PER_JOB + 1)
+
+    @requests_mock.Mocker()
+    def test_chunks_joined_in_input_order(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=_create_job_callback)
+        mocker.get(re.compile("output/succeeded"), text=_output_callback)
+        multi_job = MultiGeocodingJob(self.test_data, chunk_size=1, max_concurrent_jobs=2)
+        results = multi_job.fetch_results()
+        self.assertEqual(list(results["Id"]), [4, 7, 13])
+        self.assertEqual(len(multi_job.jobs), 3)
+        self.assertTrue(all(job.status == GeocodingJob.GCStatus.completed for job in multi_job.jobs))
+        self.assertEqual(results[results["Id"] == 13]["GeocodeResponse/Address/Locality"].values[0], "Tampere")
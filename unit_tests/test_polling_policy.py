@@ -0,0 +1,34 @@
+import unittest
+from geocoding_job.polling_policy import PollingPolicy
+
+
+class TestPollingPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = PollingPolicy(initial_interval_seconds=1, backoff_factor=2, max_interval_seconds=30, jitter=0,
+                                    seconds_per_entity=0.01)
+
+    def test_exponential_backoff_up_to_bound(self):
+        self.assertEqual([self.policy.interval(attempt) for attempt in range(7)], [1, 2, 4, 8, 16, 30, 30])
+
+    def test_large_jobs_start_from_longer_intervals(self):
+        self.assertEqual(self.policy.interval(0, entity_count=1000), 2.5)
+
+    def test_progress_hint_shortens_interval(self):
+        resource = {'status': 'Pending', 'processedEntityCount': 900, 'totalEntityCount': 1000}
+        self.assertEqual(self.policy.interval(4, entity_count=1000, resource=resource, elapsed_seconds=27), 3)
+
+    def test_jitter_stays_within_bounds(self):
+        policy = PollingPolicy(initial_interval_seconds=10, jitter=0.5)
+        intervals = [policy.interval(0) for _ in range(100)]
+        self.assertTrue(all(5 <= interval <= 15 for interval in intervals))
+        self.assertTrue(len(set(intervals)) > 1)
+
+    def test_long_running_jobs(self):
+        self.assertEqual(self.policy.interval(1030), 30)
+        self.assertEqual(PollingPolicy(initial_interval_seconds=0).interval(1030), 0)
+
+    def test_jitter_does_not_exceed_bound(self):
+        policy = PollingPolicy(initial_interval_seconds=1, max_interval_seconds=30, jitter=0.5)
+        intervals = [policy.interval(10) for _ in range(100)]
+        self.assertTrue(all(15 <= interval <= 30 for interval in intervals))
+        self.assertTrue(min(intervals) < 30)
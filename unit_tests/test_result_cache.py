@@ -0,0 +1,91 @@
+import unittest
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+import pandas
+from test_data import TEST_DATA_DIR
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.result_cache import ResultCache
+from unit_tests.test_geocoding_job import STATUS_RESPONSE_CONTENT, TEST_BING_CSV_RESPONSE, TEST_BING_XML_RESPONSE
+import requests_mock
+import re
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(TEST_DATA_DIR, 'test_request_data.csv'), 'r') as testfile:
+            self.test_data = pandas.read_csv(StringIO(testfile.read()), delimiter=";", header=0)
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.cache_dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _fetch_with_mock(self, cache):
+        with requests_mock.Mocker() as mocker:
+            mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+            mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+            return GeocodingJob(self.test_data, cache=cache).fetch_results()
+
+    def test_cached_rows_skip_bing(self):
+        cache = ResultCache(self.cache_path)
+        self._fetch_with_mock(cache)
+        self.assertEqual(len(cache), 3)
+
+        # Nothing is mocked here, so any request to Bing would fail.
+        renumbered = self.test_data.assign(id=self.test_data['id'] + 100)
+        job = GeocodingJob(renumbered, cache=ResultCache(self.cache_path))
+        results = job.fetch_results()
+        self.assertEqual(job.status, GeocodingJob.GCStatus.completed)
+        self.assertEqual(sorted(results["Id"]), [104, 107, 113])
+        self.assertEqual(results[results["Id"] == 113]["GeocodeResponse/Address/Locality"].values[0], "Tampere")
+
+        compact = GeocodingJob(renumbered, cache=cache).fetch_results(result_schema=GeocodingJob.COMPACT_RESULT_SCHEMA)
+        self.assertEqual(sorted(compact.columns), sorted(GeocodingJob.COMPACT_RESULT_SCHEMA))
+        self.assertEqual(str(compact["GeocodeResponse/Point/Latitude"].dtype), "float32")
+
+    def test_only_misses_are_sent(self):
+        cache = ResultCache(self.cache_path)
+        self._fetch_with_mock(cache)
+        extended = self.test_data.append(pandas.DataFrame(
+            {'id': [99], 'streetAddress': ['Mannerheimintie 1'], 'postcode': ['00100'], 'municipality': ['Helsinki']}),
+            ignore_index=True, sort=False)
+        hits, misses = cache.lookup(GeocodingJob._build_payload_df(extended))
+        self.assertEqual(sorted(hits["Id"]), [4, 7, 13])
+        self.assertEqual(list(misses["Id"]), [99])
+
+    def test_expired_and_excess_entries(self):
+        self._fetch_with_mock(ResultCache(self.cache_path, max_entries=2))
+        self.assertEqual(len(ResultCache(self.cache_path)), 2)
+        hits, misses = ResultCache(self.cache_path, ttl_seconds=-1).lookup(
+            GeocodingJob._build_payload_df(self.test_data))
+        self.assertEqual(len(hits), 0)
+        self.assertEqual(len(misses), 3)
+
+    def test_non_ascii_values_round_trip(self):
+        data = self.test_data.assign(streetAddress="M\xc3\xa4nts\xc3\xa4l\xc3\xa4ntie 1", id=[1, 2, 3])
+        payload_df = GeocodingJob._build_payload_df(data)
+        results = pandas.read_csv(StringIO(TEST_BING_CSV_RESPONSE), header=1).assign(Id=[1, 2, 3])
+        results["GeocodeResponse/Address/AdminDistrict"] = "Etel\xc3\xa4-Suomi"
+        ResultCache(self.cache_path).store(payload_df, results)
+        hits, misses = ResultCache(self.cache_path).lookup(payload_df)
+        self.assertEqual(len(hits), 3)
+        self.assertEqual(len(misses), 0)
+        admin_district = hits["GeocodeResponse/Address/AdminDistrict"][0]
+        self.assertEqual(admin_district, "Etel\xc3\xa4-Suomi")
+        self.assertTrue(isinstance(admin_district, str))
+        self.assertEqual(hits["GeocodeResponse/Point/Latitude"][0], results["GeocodeResponse/Point/Latitude"][0])
+        csv = StringIO()
+        hits.to_csv(csv, index=False)
+        self.assertTrue("Etel\xc3\xa4-Suomi" in csv.getvalue())
+
+    def test_schema_string_columns_parsed_as_strings(self):
+        for input_format, response in [("csv", TEST_BING_CSV_RESPONSE), ("xml", TEST_BING_XML_RESPONSE)]:
+            with requests_mock.Mocker() as mocker:
+                mocker.post(re.compile("spatial.virtualearth.net"), text=STATUS_RESPONSE_CONTENT)
+                mocker.get(re.compile("output/succeeded"), content=response)
+                results = GeocodingJob(self.test_data, cache=ResultCache(self.cache_path + input_format),
+                                       input_format=input_format).fetch_results(GeocodingJob.COMPACT_RESULT_SCHEMA)
+            self.assertEqual(sorted(results["GeocodeResponse/Address/PostalCode"]), ["00100", "01300", "33100"])
+            self.assertEqual(str(results["GeocodeResponse/Point/Latitude"].dtype), "float32")
@@ -0,0 +1,105 @@
+import unittest
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+import numpy
+import pandas
+from geocoding_job.geocoding_job import GeocodingJob
+from geocoding_job.spatial_index import SpatialIndex
+from unit_tests.test_geocoding_job import TEST_BING_CSV_RESPONSE
+import requests_mock
+import json
+import re
+
+
+class TestSpatialIndex(unittest.TestCase):
+    def setUp(self):
+        self.results = pandas.read_csv(StringIO(TEST_BING_CSV_RESPONSE), header=1)
+        self.index = SpatialIndex(self.results)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _queries(self, points):
+        return pandas.DataFrame({"Id": range(len(points)),
+                                 SpatialIndex.QUERY_LATITUDE: [point[0] for point in points],
+                                 SpatialIndex.QUERY_LONGITUDE: [point[1] for point in points]})
+
+    def _point(self, request_id):
+        row = self.results[self.results["Id"] == request_id].iloc[0]
+        return row[SpatialIndex.LATITUDE], row[SpatialIndex.LONGITUDE]
+
+    def test_reverse_geocode(self):
+        latitude, longitude = self._point(13)
+        # About 50 meters north of the point, and the middle of the sea.
+        hits, misses = self.index.reverse_geocode(self._queries([(latitude + 0.00045, longitude), (60.0, 20.0)]))
+        self.assertEqual(list(hits["Id"]), [0])
+        self.assertEqual(hits["GeocodeResponse/Address/Locality"][0], "Tampere")
+        self.assertEqual(hits[SpatialIndex.QUERY_LATITUDE][0], latitude + 0.00045)
+        self.assertEqual(list(misses["Id"]), [1])
+        hits, misses = self.index.reverse_geocode(self._queries([(latitude + 0.00045, longitude)]),
+                                                  max_distance_meters=40)
+        self.assertTrue(hits.empty)
+
+    def test_nearest_of_random_points(self):
+        random = numpy.random.RandomState(0)
+        points = pandas.DataFrame({SpatialIndex.LATITUDE: random.uniform(60, 60.1, 5000),
+                                   SpatialIndex.LONGITUDE: random.uniform(24, 24.2, 5000)})
+        index = SpatialIndex(points, cell_meters=50)
+        queries = self._queries(zip(random.uniform(60, 60.1, 500), random.uniform(24, 24.2, 500)))
+        hits, misses = index.reverse_geocode(queries, max_distance_meters=100)
+        self.assertEqual(len(hits) + len(misses), 500)
+        query_vectors = SpatialIndex._unit_vectors(queries[SpatialIndex.QUERY_LATITUDE],
+                                                   queries[SpatialIndex.QUERY_LONGITUDE])
+        for _, hit in hits.iterrows():
+            distances = numpy.sqrt(((index._vectors - query_vectors[int(hit["Id"])]) ** 2).sum(axis=1))
+            nearest = index.points.iloc[distances.argmin()]
+            self.assertEqual(hit[SpatialIndex.LATITUDE], nearest[SpatialIndex.LATITUDE])
+        for _, miss in misses.iterrows():
+            distances = numpy.sqrt(((index._vectors - query_vectors[int(miss["Id"])]) ** 2).sum(axis=1))
+            self.assertTrue(distances.min() * SpatialIndex.EARTH_RADIUS_METERS > 100)
+
+    def test_bounding_box(self):
+        points = self.index.bounding_box(60.0, 24.0, 61.0, 26.0)
+        self.assertEqual(sorted(points["GeocodeResponse/Address/Locality"]), ["Helsinki", "Vantaa"])
+        self.assertEqual(len(self.index.bounding_box(60.0, 170.0, 61.0, -170.0)), 0)
+
+    def test_bounding_box_of_random_points(self):
+        random = numpy.random.RandomState(0)
+        points = pandas.DataFrame({SpatialIndex.LATITUDE: random.uniform(60, 61, 5000),
+                                   SpatialIndex.LONGITUDE: random.uniform(24, 26, 5000)})
+        index = SpatialIndex(points)
+        latitudes, longitudes = index.points[SpatialIndex.LATITUDE], index.points[SpatialIndex.LONGITUDE]
+        expected = index.points[latitudes.between(60.2, 60.4) & longitudes.between(24.5, 25.0)]
+        self.assertTrue(index.bounding_box(60.2, 24.5, 60.4, 25.0).equals(expected.reset_index(drop=True)))
+        self.assertEqual(len(SpatialIndex().bounding_box(60.0, 24.0, 61.0, 26.0)), 0)
+
+    def test_saved_and_loaded(self):
+        path = os.path.join(self.directory, 'index.pickle')
+        self.index.save(path)
+        index = SpatialIndex.load(path)
+        self.assertEqual(len(index), 3)
+        hits, _ = index.reverse_geocode(self._queries([self._point(4)]))
+        self.assertEqual(hits["GeocodeResponse/Address/Locality"][0], "Vantaa")
+
+    def test_points_added(self):
+        index = SpatialIndex(self.results[self.results["Id"] == 4])
+        index.add([self.results, self.results[self.results["Id"] == 7]])
+        self.assertEqual(len(index), 3)
+
+    @requests_mock.Mocker()
+    def test_misses_reverse_geocoded_by_bing(self, mocker):
+        mocker.post(re.compile("spatial.virtualearth.net"), text=json.dumps({'resourceSets': [{'resources': [
+            {'status': 'Completed', 'links': [{'name': 'succeeded', 'role': 'output',
+                                               'url': 'http://spatial.virtualearth.net/foo/output/succeeded'}]}]}]}))
+        mocker.get(re.compile("output/succeeded"), text=TEST_BING_CSV_RESPONSE)
+        _, misses = SpatialIndex().reverse_geocode(self._queries([self._point(7)]))
+        job = SpatialIndex.reverse_geocoding_job(misses, bing_key="test")
+        job.fetch_results()
+        payload = pandas.read_csv(StringIO("".join(mocker.request_history[0].body)), header=1)
+        self.assertEqual(list(payload.columns), SpatialIndex.REVERSE_PAYLOAD_HEADERS)
+        self.assertEqual(payload[SpatialIndex.QUERY_LATITUDE][0], self._point(7)[0])
+        with self.assertRaises(GeocodingJob.GeocodingException):
+            SpatialIndex.reverse_geocoding_job(misses, bing_key="test", deduplicate=True)